@@ -1,7 +1,7 @@
 #!/bin/bash
 #SBATCH --account=def-mlepage
-#SBATCH --ntasks=4
-#SBATCH --cpus-per-task=4
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=16
 #SBATCH --mem-per-cpu=1G
 #SBATCH --time=1:00:00
 
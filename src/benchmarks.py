@@ -0,0 +1,176 @@
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from .data.build import DataBuilder
+from .models.classify import BestKNeighborsClassifier, BestRandomForestClassifier, BestRidgeClassifier, BestSVC
+
+
+def time_call(f, *args, repeat: int = 3, **kwargs) -> float:
+    """ Return the best wall-clock time in seconds over several calls of f """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_diagnoses_df(n_rows: int, n_cols: int = 226, fill: float = 0.02, seed: int = 0) -> pd.DataFrame:
+    """ Return a synthetic frame shaped like the diagnoses array columns of the raw extract """
+    rng = np.random.default_rng(seed)
+    codes = np.array(["F200", "F209", "F25", "F320", "F329", "F331", "F03", "F410", "I10", "E119", "K219"])
+    df = pd.DataFrame({DataBuilder.idvar: np.arange(n_rows).astype(str)})
+    values = rng.choice(codes, size=(n_rows, n_cols)).astype(object)
+    values[rng.random((n_rows, n_cols)) > fill] = np.nan
+    return pd.concat([df, pd.DataFrame(values, columns=[f"diagnoses{i}" for i in range(n_cols)])], axis=1)
+
+
+def _legacy_add_binary_variables(df: pd.DataFrame, target: str, patterns: dict) -> pd.DataFrame:
+    """ Row-wise implementation of DataBuilder.add_binary_variables, kept as a reference """
+    idvar = DataBuilder.idvar
+    cols = [col for col in df if col.startswith(target)]
+    new_vars = {var_name: [] for var_name in [idvar] + list(patterns.keys())}
+    for index, row in df[cols].iterrows():
+        new_vars[idvar].append(df[idvar][index])
+        for pat in patterns:
+            for value in row:
+                try:
+                    if re.match(patterns[pat], value) is not None:
+                        new_vars[pat].append(True)
+                        break
+                except TypeError:
+                    continue
+            if len(new_vars[idvar]) != len(new_vars[pat]):
+                new_vars[pat].append(False)
+    return pd.merge(df, pd.DataFrame(new_vars), left_on=idvar, right_on=idvar)
+
+
+def make_coded_df(n_rows: int, fill: float = 0.02, seed: int = 0) -> pd.DataFrame:
+    """ Return a synthetic frame of every coded column, typed with the dtype plan of DataBuilder """
+    rng = np.random.default_rng(seed)
+    builder = DataBuilder.__new__(DataBuilder)
+    dtypes = builder.get_dtypes()
+    data = {}
+    for var, columns in builder.get_var_columns().items():
+        coding = builder.variables[var]["Coding"]
+        if coding is None:
+            continue
+        codes = list(coding.keys())
+        for ukbb_var, recoded_var in columns:
+            col_fill = fill if len(columns) > 1 else 1
+            indices = np.where(rng.random(n_rows) < col_fill, rng.integers(0, len(codes), n_rows), -1)
+            if dtypes[ukbb_var] == "category":
+                data[recoded_var] = pd.Categorical.from_codes(indices, categories=codes)
+            else:
+                values = np.array(codes, dtype="float32")[indices]
+                values[indices == -1] = np.nan
+                data[recoded_var] = values
+    return pd.DataFrame(data)
+
+
+def _legacy_recode(df: pd.DataFrame) -> pd.DataFrame:
+    """ Prefix scan and per-variable DataFrame.replace, as previously done by DataBuilder """
+    for name, config in DataBuilder.variables.items():
+        cols = [col for col in df.columns if col.startswith(name)]
+        if config["Included"] and cols != [] and config["Coding"] is not None:
+            df[cols] = df[cols].replace(to_replace=config["Coding"])
+    return df
+
+
+def benchmark_recoding(sizes: tuple = (10000, 100000, 500000), legacy_max_rows: int = 10000) -> pd.DataFrame:
+    """ 
+    Time the recoding stage on synthetic data of increasing size. The previous implementation ran 
+    on string columns and is only timed up to legacy_max_rows, as it takes minutes beyond that.
+    """
+    builder = DataBuilder.__new__(DataBuilder)
+    builder._codings = builder.get_codings()
+    results = {}
+    for n_rows in sizes:
+        df = make_coded_df(n_rows)
+        results[n_rows] = {
+            "Replace (s)": np.nan,
+            "Recode (s)": time_call(lambda: builder.recode_columns(df.copy()), repeat=1)
+        }
+        if n_rows <= legacy_max_rows:
+            df_str = df.astype(object).applymap(lambda x: x if pd.isna(x) else str(x).removesuffix(".0"))
+            results[n_rows]["Replace (s)"] = time_call(lambda: _legacy_recode(df_str.copy()), repeat=1)
+    results = pd.DataFrame(results).T
+    results["Speedup"] = results["Replace (s)"] / results["Recode (s)"]
+    return results
+
+
+def benchmark_binary_variables(sizes: tuple = (1000, 10000), repeat: int = 3) -> pd.DataFrame:
+    """ Compare the row-wise and vectorized diagnosis flagging on synthetic data """
+    builder = DataBuilder.__new__(DataBuilder)
+    builder._verbose = False
+    patterns = DataBuilder.selected_diagnoses
+    results = {}
+    for n_rows in sizes:
+        df = make_diagnoses_df(n_rows)
+        expected = _legacy_add_binary_variables(df, "diagnoses", patterns)
+        actual = builder.add_binary_variables(df, "diagnoses", patterns)
+        if not expected[list(patterns)].equals(actual[list(patterns)]):
+            raise AssertionError(f"Vectorized flags differ from row-wise flags for {n_rows} rows")
+        results[n_rows] = {
+            "Loop (s)": time_call(_legacy_add_binary_variables, df, "diagnoses", patterns, repeat=1),
+            "Vectorized (s)": time_call(builder.add_binary_variables, df, "diagnoses", patterns, repeat=repeat)
+        }
+    results = pd.DataFrame(results).T
+    results["Speedup"] = results["Loop (s)"] / results["Vectorized (s)"]
+    return results
+
+
+def make_classification_data(n_rows: int = 3000, n_features: int = 186, seed: int = 0) -> tuple:
+    """ Return a synthetic matrix shaped like the imaging features, and a noisy binary target """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+    y = (X[:, :10].sum(axis=1) + rng.normal(scale=3, size=n_rows) > 0).astype(int)
+    return X, y
+
+
+def benchmark_search_folds(n_rows: int = 3000, n_features: int = 186, n_jobs: int = 1, 
+                           seed: int = 0) -> pd.DataFrame:
+    """ Time the Bayesian search of fast classifiers with and without folds preprocessed once """
+    X, y = make_classification_data(n_rows, n_features, seed)
+    results = {}
+    for model in [BestKNeighborsClassifier, BestRidgeClassifier]:
+        times = {}
+        for label, precompute_folds in [("Per candidate (s)", False), ("Precomputed (s)", True)]:
+            clf = model(score_method='roc_auc')
+            clf.precompute_folds = precompute_folds
+            times[label] = time_call(clf.fit, X, y, n_jobs=n_jobs, random_state=seed, repeat=1)
+        results[str(clf)] = times
+    results = pd.DataFrame(results).T
+    results["Speedup"] = results["Per candidate (s)"] / results["Precomputed (s)"]
+    return results
+
+
+def benchmark_search_methods(n_rows: int = 600, n_features: int = 186, n_jobs: int = -1, 
+                             seed: int = 0) -> pd.DataFrame:
+    """ Compare the time and held-out AUC of full Bayesian and successive halving searches """
+    X, y = make_classification_data(2 * n_rows, n_features, seed)
+    X_test, y_test = X[n_rows:], y[n_rows:]
+    X, y = X[:n_rows], y[:n_rows]
+    results = {}
+    for model in [BestRandomForestClassifier, BestSVC]:
+        for search_method in ["bayes", "halving"]:
+            clf = model(score_method='roc_auc', search_method=search_method)
+            elapsed = time_call(clf.fit, X, y, n_jobs=n_jobs, random_state=seed, repeat=1)
+            results[(str(clf), search_method)] = {
+                "Time (s)": elapsed,
+                "CV AUC": clf.best_score_,
+                "Test AUC": clf.score(X_test, y_test)
+            }
+    return pd.DataFrame(results).T
+
+
+if __name__ == "__main__":
+    print(benchmark_binary_variables())
+    print(benchmark_recoding())
+    print(benchmark_search_folds())
+    print(benchmark_search_methods())
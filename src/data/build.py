@@ -1,16 +1,29 @@
 import copy
+import inspect
 import os
 import re
 from datetime import date, datetime
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 
-from sklearn.neighbors import NearestNeighbors
+from .cache import RawExtract
+from .match import ControlMatcher
+from .stages import StageCache
+from .store import DatasetStore
 from .variables import load_variables
 from ..filepaths import PATH_CURRENT_CSV, PATH_DATA_DIR
 
 
+@lru_cache(maxsize=4)
+def read_dataset(filepath: str, mtime_ns: int) -> pd.DataFrame:
+    """ Read a saved dataset, caching the most recently used files by path and modification time """
+    if filepath.endswith(".csv"):
+        return pd.read_csv(filepath)
+    return DatasetStore.read_file(filepath)
+
+
 class DataBuilder:
     """ class to subset and recode raw data """
 
@@ -32,6 +45,30 @@ class DataBuilder:
 
     selected_diagnoses = included_diagnoses | excluded_diagnoses | any_mental_disorder
 
+    id_dtype = "Int32"
+
+    match_ratio = 1
+    match_caliper = None
+
+    # Stages of a full build whose outputs are saved to the stage cache: the renamed raw data, so that
+    # the extract is not parsed again, and the small filtered frame, so that only matching is rerun
+    cached_stages = ["rename", "filter"]
+
+    # Methods of each stage whose source is part of its cache key, so that changes to them invalidate it
+    stage_methods = {
+        "read": [],
+        "rename": ["rename_columns"],
+        "flags": ["add_flags", "add_binary_variables", "get_diagnosis_index"],
+        "recode": ["recode_columns", "recode"],
+        "filter": ["filter_rows", "compute_dx"]
+    }
+
+    numeric_dtypes = {
+        "characteristics": "Int16",
+        "cognition": "float32",
+        "imaging": "float32"
+    }
+
     edu_levels = {
         "EduNoneOfTheAbove": "None of the above",
         "EduDeclineToAnswer": "Prefer not to answer",
@@ -43,131 +80,357 @@ class DataBuilder:
         "EduOtherProfQual": "Other professional qualifications eg: nursing, teaching"
     }
 
-    def __init__(self, drop_dx: bool = True, drop_na: bool = True, path_csv: str = PATH_CURRENT_CSV, verbose: bool = False) -> None:
+    def __init__(self, drop_dx: bool = True, drop_na: bool = True, path_csv: str = PATH_CURRENT_CSV,
+                 chunksize: int | None = None, use_cache: bool = True, stage_dir: str | None = None,
+                 verbose: bool = False) -> None:
         
+        ukbb_vars, dtypes = self.configure(drop_dx, drop_na, verbose)
+
+        if use_cache:
+            raw = RawExtract(path_csv)
+            self.printv("Checking raw data cache...")
+            if raw.update():
+                self.printv(f"Rebuilt cache: {raw.path_cache}")
+            source_id = raw.get_metadata()["source_sha256"]
+        else:
+            stat = os.stat(path_csv)
+            source_id = f"{os.path.abspath(path_csv)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        stage_cache = None if stage_dir is None else StageCache(stage_dir)
+        keys = self.get_stage_keys(source_id, dtypes)
+        self.config_hash = StageCache.get_key(keys["filter"], "match", [self.match_ratio, self.match_caliper])
+
+        self.df = None if stage_cache is None else self.load_stage(stage_cache, "filter", keys)
+        if self.df is not None:
+            self.printv("Loaded filtered data from stage cache!")
+        elif chunksize is None:
+            def read(_):
+                if use_cache:
+                    return raw.read(ukbb_vars, dtypes)
+                return pd.read_csv(path_csv, dtype=dtypes, usecols=ukbb_vars)
+            self.df = self.run_stages(read, keys, stage_cache)
+        else:
+            self.printv(f"Begin streaming raw data in chunks of {chunksize} rows...")
+            if use_cache:
+                empty_cols = [self._renames[col] for col in raw.get_empty_columns(ukbb_vars)]
+                chunks = raw.iter_chunks(ukbb_vars, chunksize, dtypes)
+            else:
+                empty_cols = self.get_empty_columns(path_csv, ukbb_vars, chunksize)
+                chunks = pd.read_csv(path_csv, dtype=dtypes, usecols=ukbb_vars, chunksize=chunksize)
+            self.df = pd.concat([self.process(chunk, empty_cols) for chunk in chunks])
+            self.df = self.df.astype({
+                self._renames[col]: "category" for col, dtype in dtypes.items() 
+                if dtype == "category" and self._renames[col] in self.df
+            })
+            if stage_cache is not None:
+                self.save_stage(stage_cache, "filter", keys, self.df)
+        self.printv("Done!")
+        
+        self.patient_df = self.get_patients()
+        self.control_df = self.get_controls()
+        self.matched_controls = self.get_matched_controls(self.patient_df, self.control_df)
+        self.patient_df = self.patient_df.loc[self.matcher.pairs_["patient"].unique()]
+        self.df = pd.concat([self.patient_df, self.matched_controls])
+        assert self.match_ratio * sum(self.df['subjectType'] == 'patient') == sum(self.df['subjectType'] == 'control')
+        diagnoses = self.get_diagnoses()
+        self.diagnoses = diagnoses[diagnoses[self.idvar].isin(self.df[self.idvar])].reset_index(drop=True)
+
+    def configure(self, drop_dx: bool, drop_na: bool, verbose: bool) -> tuple:
+        """ Set the options and column mappings of the build, returning the raw variables and their dtypes """
         self._verbose = verbose
+        self._drop_dx = drop_dx
+        self._drop_na = drop_na
+        self._diagnosis_parts = []
 
         self.printv("Begin getting variable names...")
         ukbb_vars, recoded_vars = self.get_var_names()
+        self._renames = {k: v for k, v in zip(ukbb_vars, recoded_vars)}
+        dtypes = self.get_dtypes()
+        self._codings = self.get_codings()
         self.printv("Done!")
+        return ukbb_vars, dtypes
 
-        self.printv("Begin reading CSV...")
-        self.df = pd.read_csv(path_csv, dtype=str, usecols=ukbb_vars)
-        self.df.rename({k: v for k, v in zip(ukbb_vars, recoded_vars)}, axis=1, inplace=True)
-        self.df.dropna(axis=1, how="all", inplace=True)
-        self.printv("Done!")
+    @classmethod
+    def iter_cohort(cls, columns: list, chunksize: int = 100000, path_csv: str = PATH_CURRENT_CSV):
+        """ 
+        Yield the requested columns of every participant in the raw extract who passes the exclusion
+        criteria and has no missing values in those columns, in DataFrames of at most chunksize rows. 
+        Unlike a build, participants are neither required to have every variable nor matched.
+        """
+        builder = cls.__new__(cls)
+        ukbb_vars, dtypes = builder.configure(drop_dx=True, drop_na=False, verbose=False)
+        raw = RawExtract(path_csv)
+        raw.update()
+        empty_cols = [builder._renames[col] for col in raw.get_empty_columns(ukbb_vars)]
+        for chunk in raw.iter_chunks(ukbb_vars, chunksize, dtypes):
+            df = builder.process(chunk, empty_cols)[columns].dropna()
+            builder._diagnosis_parts = []
+            if len(df):
+                yield df
+
+    def get_stage_keys(self, source_id: str, dtypes: dict) -> dict:
+        """ Return the cache key of each per-row stage, chained from the config of every stage up to it """
+        configs = {
+            "read": [source_id, dtypes],
+            "rename": [self._renames],
+            "flags": [self.edu_levels, self.selected_diagnoses, self._drop_dx],
+            "recode": [{var: self.variables[var]["Coding"] for var in self.get_var_columns()}],
+            "filter": [self._drop_na, self.included_diagnoses, self.excluded_diagnoses, self.any_mental_disorder]
+        }
+        keys, key = {}, None
+        for stage, config in configs.items():
+            source = [inspect.getsource(getattr(type(self), name)) for name in self.stage_methods[stage]]
+            key = StageCache.get_key(key, stage, config, source)
+            keys[stage] = key
+        return keys
+
+    def run_stages(self, read, keys: dict, stage_cache: StageCache | None = None) -> pd.DataFrame:
+        """ 
+        Run the per-row stages on the full extract, starting from the output of the latest stage 
+        found in the stage cache (if any), and saving the output of each of cached_stages that is run.
+        """
+        stages = {
+            "read": read,
+            "rename": self.rename_columns,
+            "flags": self.add_flags,
+            "recode": self.recode_columns,
+            "filter": self.filter_rows
+        }
+        df, start = None, 0
+        if stage_cache is not None:
+            for i, stage in reversed(list(enumerate(stages))):
+                if stage not in self.cached_stages:
+                    continue
+                df = self.load_stage(stage_cache, stage, keys)
+                if df is not None:
+                    self.printv(f"Loaded stage from cache: {stage}")
+                    start = i + 1
+                    break
+        for stage in list(stages)[start:]:
+            self.printv(f"Begin stage: {stage}...")
+            df = stages[stage](df)
+            if stage_cache is not None and stage in self.cached_stages:
+                self.save_stage(stage_cache, stage, keys, df)
+            self.printv("Done!")
+        return df
+
+    def load_stage(self, stage_cache: StageCache, stage: str, keys: dict) -> pd.DataFrame | None:
+        """ 
+        Return the cached output of a stage, or None if it has not been computed. Outputs of the flags
+        stage onwards are only used if the diagnosis index saved with them is cached too.
+        """
+        df = stage_cache.load(stage, keys[stage])
+        if df is None or list(keys).index(stage) < list(keys).index("flags"):
+            return df
+        diagnoses = stage_cache.load("diagnoses", keys[stage])
+        if diagnoses is None:
+            return None
+        self._diagnosis_parts = [diagnoses]
+        return df
 
+    def save_stage(self, stage_cache: StageCache, stage: str, keys: dict, df: pd.DataFrame) -> None:
+        """ Save the output of a stage, along with the diagnosis index if the stage comes after flags """
+        if list(keys).index(stage) >= list(keys).index("flags"):
+            stage_cache.save("diagnoses", keys[stage], self.get_diagnoses())
+        stage_cache.save(stage, keys[stage], df)
+
+    def process(self, df: pd.DataFrame, empty_cols: list | None = None) -> pd.DataFrame:
+        """ 
+        Apply the per-row stages of the build to raw data, which may be the full extract or a 
+        single chunk of it, and return only the rows that survive the exclusion criteria. Columns
+        that are entirely missing are dropped; when processing chunks, these must be determined 
+        on the full extract beforehand and passed as empty_cols.
+        """
+        df = self.rename_columns(df, empty_cols)
+        df = self.add_flags(df)
+        df = self.recode_columns(df)
+        return self.filter_rows(df)
+
+    def rename_columns(self, df: pd.DataFrame, empty_cols: list | None = None) -> pd.DataFrame:
+        df = df.rename(self._renames, axis=1)
+        if empty_cols is None:
+            return df.dropna(axis=1, how="all")
+        return df.drop(empty_cols, axis=1)
+
+    def add_flags(self, df: pd.DataFrame) -> pd.DataFrame:
         self.printv("Begin getting education...")
-        self.df = self.add_binary_variables(self.df, "educationalQualifications", self.edu_levels, drop_target=True)
+        df = self.add_binary_variables(df, "educationalQualifications", self.edu_levels, drop_target=True)
         self.printv("Done!")
 
         self.printv("Begin adding diagnoses...")
-        self.df = self.add_binary_variables(self.df, "diagnoses", self.selected_diagnoses, drop_target=drop_dx)
+        self._diagnosis_parts.append(self.get_diagnosis_index(df, "diagnoses"))
+        df = self.add_binary_variables(df, "diagnoses", self.selected_diagnoses, drop_target=self._drop_dx)
         self.printv("Done!")
+        return df
 
-        self.printv("Begin iterating...")
-        for name in self.variables:
-            self.printv(f"Variable: {name}")
-            cols = [col for col in self.df.columns if col.startswith(name)]
-            self.printv(f"Columns: {cols}")
-            if self.variables[name]["Included"] and cols != [] and self.variables[name]["Coding"] is not None:
-                self.printv(f"Replace: {self.variables[name]['Coding']}")
-                self.df[cols] = self.df[cols].replace(to_replace=self.variables[name]["Coding"])
-
-        self.df.reset_index(drop=True, inplace=True)
-        self.df = self.df.apply(pd.to_numeric, errors="ignore")
+    def get_diagnoses(self) -> pd.DataFrame:
+        """ Return the diagnosis index of every row that has gone through the flags stage """
+        if len(self._diagnosis_parts) > 1:
+            diagnoses = pd.concat(self._diagnosis_parts, ignore_index=True)
+            self._diagnosis_parts = [diagnoses.astype({"code": "category"})]
+        return self._diagnosis_parts[0]
 
-        if drop_na:
-            self.df.dropna(how="any", inplace=True)
+    @classmethod
+    def get_diagnosis_index(cls, df: pd.DataFrame, target: str) -> pd.DataFrame:
+        """ 
+        Return a long-format index of the raw codes in the columns of a variable, with one row for 
+        each distinct pair of id and code. It is built before the codes are recoded or dropped.
+        """
+        ids = df[cls.idvar].to_numpy()
+        parts = []
+        for col in [col for col in df if col.startswith(target)]:
+            has_value = df[col].notna().to_numpy()
+            parts.append(pd.DataFrame({cls.idvar: ids[has_value], "code": df[col].to_numpy()[has_value]}))
+        if not parts:
+            return pd.DataFrame({cls.idvar: pd.Series(dtype=cls.id_dtype), "code": pd.Series(dtype="category")})
+        index = pd.concat(parts, ignore_index=True).drop_duplicates(ignore_index=True)
+        return index.astype({cls.idvar: cls.id_dtype, "code": "category"})
+
+    def filter_rows(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self._drop_na:
+            df = df.dropna(how="any")
 
         self.printv("Assigning diagnoses...")
-        self.df = self.df.assign(dx=self.df.apply(self.compute_dx, axis=1))
+        df = df.assign(dx=self.compute_dx(df))
         self.printv("Done!")
 
-        self.df.drop(list(self.selected_diagnoses.keys()), axis=1)
-
         for key in self.excluded_diagnoses:
-            self.df = self.df[self.df[key] == False]
-        self.df = self.df[self.df['handedness'] == "Right-handed"]
-        
-        self.patient_df = self.get_patients()
-        self.control_df = self.get_controls()
-        self.matched_controls = self.get_matched_controls(self.patient_df, self.control_df)
-        self.df = pd.concat([self.patient_df, self.matched_controls])
-        assert sum(self.df['subjectType'] == 'patient') == sum(self.df['subjectType'] == 'control')
+            df = df[df[key] == False]
+        df = df[df['handedness'] == "Right-handed"]
+
+        # Only the diagnoses of surviving rows are kept, so a streamed build holds the index of one chunk at a time
+        diagnoses = self._diagnosis_parts[-1]
+        self._diagnosis_parts[-1] = diagnoses[diagnoses[self.idvar].isin(df[self.idvar])]
+        return df
+
+    def get_empty_columns(self, path_csv: str, usecols: list, chunksize: int) -> list:
+        """ Return the recoded names of columns with no values in the raw CSV, read in chunks """
+        has_values = None
+        for chunk in pd.read_csv(path_csv, dtype=str, usecols=usecols, chunksize=chunksize):
+            chunk_has_values = chunk.notna().any()
+            has_values = chunk_has_values if has_values is None else has_values | chunk_has_values
+        return [self._renames[col] for col in has_values.index[~has_values]]
     
     def printv(self, msg: str):
         if self._verbose:
             print(msg)
 
+    def get_var_columns(self) -> dict:
+        """ Return a mapping of each included variable to pairs of its actual and recoded column names """
+        var_columns = {}
+        for var in self.variables:
+            if self.variables[var]["Included"]:
+                array_range = self.variables[var]['ArrayRange']
+                ukbb_vars = [f"{self.variables[var]['DataField']}-{self.variables[var]['InstanceNum']}.{i}" for i in array_range]
+                recoded_vars = [var] if len(array_range) == 1 else [f"{var}{i}" for i in array_range]
+                var_columns[var] = list(zip(ukbb_vars, recoded_vars))
+        return var_columns
+
     def get_var_names(self) -> tuple:
         """ Return lists of actual and recoded variable names based on config """
         ukbb_vars, recoded_vars = ["eid"], [self.idvar]
-        for var in self.variables:
-            if self.variables[var]["Included"]:
-                array_vars = []
-                for i in self.variables[var]['ArrayRange']:
-                    array_vars.append(f"{self.variables[var]['DataField']}-{self.variables[var]['InstanceNum']}.{i}")
-                ukbb_vars += array_vars
-                if len(self.variables[var]['ArrayRange']) == 1:
-                    recoded_vars.append(var)
-                else:
-                    array_vars = []
-                    for i in self.variables[var]['ArrayRange']:
-                        array_vars.append(f"{var}{i}")
-                    recoded_vars += array_vars
-        if len(ukbb_vars) != len(recoded_vars):
-            raise ValueError
+        for columns in self.get_var_columns().values():
+            ukbb_vars += [ukbb_var for ukbb_var, _ in columns]
+            recoded_vars += [recoded_var for _, recoded_var in columns]
         return ukbb_vars, recoded_vars
 
+    def get_dtypes(self) -> dict:
+        """ 
+        Return the dtype to read each actual variable with, based on config. Characteristics coded
+        with text labels are categorical, while other variables take the numeric dtype of their group.
+        """
+        dtypes = {"eid": self.id_dtype}
+        for var, columns in self.get_var_columns().items():
+            group, coding = self.variables[var]["Group"], self.variables[var]["Coding"]
+            if group == "characteristics" and coding is not None and any(isinstance(x, str) for x in coding.values()):
+                dtype = "category"
+            else:
+                dtype = self.numeric_dtypes[group]
+            dtypes |= {ukbb_var: dtype for ukbb_var, _ in columns}
+        return dtypes
+
+    def get_codings(self) -> dict:
+        """ Return a mapping of each recoded column name to its coding scheme, if it has one """
+        codings = {}
+        for var, columns in self.get_var_columns().items():
+            if self.variables[var]["Coding"] is not None:
+                codings |= {recoded_var: self.variables[var]["Coding"] for _, recoded_var in columns}
+        return codings
+
+    def recode_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Recode every column with a coding scheme in place, returning the same DataFrame """
+        for col in df.columns.intersection(self._codings.keys()):
+            df[col] = self.recode(df[col], self._codings[col])
+        return df
+
+    @staticmethod
+    def recode(series: pd.Series, coding: dict) -> pd.Series:
+        """ 
+        Replace Biobank codes with their meanings. Categorical variables are recoded by renaming 
+        their categories, unless this would merge categories, in which case values are mapped. For
+        numeric variables, only codes with numeric or missing meanings are replaced, so that text 
+        labels for special values (e.g. "Did not make any correct matches") keep the column numeric.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = [coding.get(x, x) for x in series.cat.categories]
+            if pd.Index(categories).is_unique and not pd.isna(categories).any():
+                return series.cat.rename_categories(categories)
+            return series.astype(object).replace(coding)
+        return series.replace({
+            float(k): np.nan if v is None else v for k, v in coding.items() if not isinstance(v, str)
+        })
+
     def add_binary_variables(self, df: pd.DataFrame, target: str, patterns: dict, drop_target: bool = False):
         """ 
         Takes as input a variable of interest and a dictionary with keys representing new
         variable names mapped onto regular expressions. New binary variables will be created
         based on whether each individual has a value matching the regular expression in any 
-        of the columns related to the variable of interest.
+        of the columns related to the variable of interest. Each regular expression is only
+        evaluated once per unique value; missing values map onto the all-False last row.
         """
 
         cols = [col for col in df if col.startswith(target)]
-        all_vars = list(patterns.keys())
-        new_vars = {var_name: [] for var_name in [self.idvar] + all_vars}
-
-        for index, row in df[cols].iterrows():
-            new_vars[self.idvar].append(df[self.idvar][index])
-            for pat in patterns:
-                for value in row:
-                    try:
-                        if re.match(patterns[pat], value) is not None:
-                            new_vars[pat].append(True)
-                            break
-                    except TypeError:
-                        continue
-                if len(new_vars[self.idvar]) != len(new_vars[pat]):
-                    new_vars[pat].append(False)
-
-        if not sum([len(x) for x in new_vars.values()]) == len(new_vars[self.idvar]) * len(new_vars.keys()):
-            raise ValueError(
-                f"{sum([len(x) for x in new_vars.values()])} != {len(new_vars['eid']) * len(new_vars.keys())}")
-
-        new_df = pd.DataFrame(new_vars)
+        regexes = {var_name: re.compile(pattern) for var_name, pattern in patterns.items()}
+        matches = {}
+        new_vars = np.zeros((len(df), len(regexes)), dtype=bool)
+
+        for col in cols:
+            codes, uniques = pd.factorize(df[col])
+            if len(uniques) == 0:
+                continue
+            lookup = np.zeros((len(uniques) + 1, len(regexes)), dtype=bool)
+            for i, value in enumerate(uniques):
+                if value not in matches:
+                    matches[value] = [isinstance(value, str) and regex.match(value) is not None
+                                      for regex in regexes.values()]
+                lookup[i] = matches[value]
+            new_vars |= lookup[codes]
+
+        new_df = pd.DataFrame(new_vars, columns=list(regexes.keys()), index=df.index)
         if drop_target:
             self.printv("Dropping target...")
-            df.drop(cols, axis=1, inplace=True)
+            df = df.drop(cols, axis=1)
             self.printv("Finished dropping target!")
-        return pd.merge(df, new_df, left_on=self.idvar, right_on=self.idvar)
+        return pd.concat([df, new_df], axis=1)
     
-    @staticmethod
-    def compute_dx(df: pd.DataFrame):
-        if df["anySSD"] & df["anyMoodDisorder"]:
-            return "SSD + Mood Disorder"
-        elif df["anySSD"]:
-            return "Only SSD"
-        elif df["anyMoodDisorder"]:
-            return "Only Mood Disorder"
-        elif ~df['anyDementia'] & ~df['anyMentalDisorder']:
-            return None
-        else:
-            raise AssertionError
+    @classmethod
+    def compute_dx(cls, df: pd.DataFrame) -> pd.Series:
+        """ 
+        Return the diagnostic group of each individual, or None for those with neither SSD nor a mood
+        disorder. Since every selected diagnosis is a mental disorder, individuals flagged with one
+        but not with anyMentalDisorder indicate inconsistent patterns, and are reported by id.
+        """
+        any_selected = df[list(cls.included_diagnoses) + list(cls.excluded_diagnoses)].any(axis=1)
+        inconsistent = any_selected & ~df["anyMentalDisorder"]
+        if inconsistent.any():
+            raise AssertionError(f"Inconsistent diagnoses for {cls.idvar}: {df.loc[inconsistent, cls.idvar].tolist()}")
+        conditions = [
+            df["anySSD"] & df["anyMoodDisorder"],
+            df["anySSD"],
+            df["anyMoodDisorder"]
+        ]
+        choices = ["SSD + Mood Disorder", "Only SSD", "Only Mood Disorder"]
+        return pd.Series(np.select(conditions, choices, default=None), index=df.index)
 
     def get_patients(self):
         list_series = [self.df[key] == True for key in self.included_diagnoses]
@@ -182,19 +445,28 @@ class DataBuilder:
         return df
     
     def write_csv(self, output_dir: str = PATH_DATA_DIR):
+        """ Save the dataset as a dated CSV file, with its diagnosis index alongside it """
         filename = os.path.join(output_dir, f"dataset_{date.today().isoformat()}.csv")
         self.df.to_csv(filename, index=False)
+        self.diagnoses.to_csv(filename.replace(".csv", "_diagnoses.csv"), index=False)
+
+    def write(self, output_dir: str = PATH_DATA_DIR) -> int:
+        """ Save the dataset as a new version in the dataset store, returning its version number """
+        return DatasetStore(output_dir).write(self.df, self.config_hash, self.diagnoses)
         
     @classmethod
     def get_latest_filepath(cls, output_dir: str = PATH_DATA_DIR):
         """ Return the path to most recent saved dataset """
 
+        if DatasetStore(output_dir).exists():
+            return DatasetStore(output_dir).get_filepath()
+
         newest_date, newest_file = None, None
         for filename in os.listdir(output_dir):
-            try:
-                file_date = datetime.fromisoformat(filename.strip("dataset_").strip(".csv"))
-            except ValueError:
+            match = re.fullmatch(r"dataset_(\d{4}-\d{2}-\d{2})\.csv", filename)
+            if match is None:
                 continue
+            file_date = datetime.fromisoformat(match.group(1))
             if newest_date is None or file_date > newest_date:
                 newest_date, newest_file = file_date, filename
 
@@ -204,23 +476,48 @@ class DataBuilder:
         return os.path.join(output_dir, newest_file)
     
     @classmethod
-    def load(cls, output_dir: str = PATH_DATA_DIR):
-        """ Returns the most recent saved dataframe """
-
-        filepath = cls.get_latest_filepath(output_dir)
-        if filepath is None:
-            raise FileNotFoundError("Could not find existing dataset")
+    def load(cls, output_dir: str = PATH_DATA_DIR, version: int | None = None, subject_type: str | None = None):
+        """ 
+        Returns the most recent saved dataframe, or a pinned version from the dataset store. CSV 
+        files written by write_csv are only used when the directory has no dataset store. Files 
+        are parsed once per process, and each call returns a writable deep copy of the cached frame,
+        or of only its rows of one subject type.
+        """
 
-        return pd.read_csv(filepath)
+        store = DatasetStore(output_dir)
+        if store.exists():
+            filepath = store.get_filepath(version)
+        elif version is not None:
+            raise FileNotFoundError(f"Could not find dataset store in: {output_dir}")
+        else:
+            filepath = cls.get_latest_filepath(output_dir)
+            if filepath is None:
+                raise FileNotFoundError("Could not find existing dataset")
+
+        df = read_dataset(filepath, os.stat(filepath).st_mtime_ns)
+        if subject_type is not None:
+            df = df.loc[df['subjectType'] == subject_type]
+        return df.copy()
     
-    @staticmethod
-    def get_matched_controls(patient_df: pd.DataFrame, control_df: pd.DataFrame):
-        match_vars = ["age", "sex"]
-        patient_features = patient_df[match_vars].to_numpy()
-        patient_features[:, 1] = np.where(patient_features[:, 1] == "Male", 1, 0)
-        control_features = control_df[match_vars].to_numpy()
-        control_features[:, 1] = np.where(control_features[:, 1] == "Male", 1, 0)
-        model = NearestNeighbors(algorithm='kd_tree')
-        model.fit(control_features)
-        _, neigh_ind = model.kneighbors(patient_features, n_neighbors=1)
-        return control_df.iloc[neigh_ind.flatten()]
\ No newline at end of file
+    @classmethod
+    def load_diagnoses(cls, output_dir: str = PATH_DATA_DIR, version: int | None = None) -> pd.DataFrame:
+        """ Return the long-format (id, code) diagnosis index saved with a version of the dataset """
+
+        store = DatasetStore(output_dir)
+        if store.exists():
+            return store.read_diagnoses(version)
+        elif version is not None:
+            raise FileNotFoundError(f"Could not find dataset store in: {output_dir}")
+
+        filepath = cls.get_latest_filepath(output_dir)
+        if filepath is None or not os.path.exists(filepath.replace(".csv", "_diagnoses.csv")):
+            raise FileNotFoundError(f"Could not find diagnosis index in: {output_dir}")
+        return pd.read_csv(filepath.replace(".csv", "_diagnoses.csv"), dtype={cls.idvar: cls.id_dtype, "code": "category"})
+
+    def get_matched_controls(self, patient_df: pd.DataFrame, control_df: pd.DataFrame):
+        """ Return controls matched to patients on sex and age, storing the matcher for diagnostics """
+        self.matcher = ControlMatcher(exact=["sex"], nearest="age", ratio=self.match_ratio, caliper=self.match_caliper)
+        pairs = self.matcher.match(patient_df, control_df)
+        self.printv(f"Matching summary:\n{self.matcher.summary_}")
+        self.printv(f"Standardized mean differences:\n{self.matcher.smd_}")
+        return control_df.loc[pairs["control"]]
@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+
+class RawExtract:
+    """
+    Columnar Parquet copy of the raw UK Biobank CSV, with one string column per
+    DataField-instance-array name (e.g. "31-0.0"). The source file's size, mtime and
+    hash are stored in the Parquet metadata, so that the copy can be rebuilt when stale.
+    """
+
+    block_size = 1 << 26
+
+    arrow_types = {
+        "float32": pa.float32(),
+        "float64": pa.float64(),
+        "Int8": pa.int8(),
+        "Int16": pa.int16(),
+        "Int32": pa.int32(),
+        "Int64": pa.int64()
+    }
+
+    pandas_types = {
+        pa.int8(): pd.Int8Dtype(),
+        pa.int16(): pd.Int16Dtype(),
+        pa.int32(): pd.Int32Dtype(),
+        pa.int64(): pd.Int64Dtype()
+    }
+
+    def __init__(self, path_csv: str, path_cache: str | None = None) -> None:
+        self.path_csv = path_csv
+        if path_cache is None:
+            path_cache = os.path.splitext(path_csv)[0] + ".parquet"
+        self.path_cache = path_cache
+        self.path_mtime = path_cache + ".mtime"
+
+    def get_source_hash(self) -> str:
+        sha256 = hashlib.sha256()
+        with open(self.path_csv, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def get_metadata(self) -> dict:
+        metadata = pq.read_schema(self.path_cache).metadata or {}
+        return {k.decode(): v.decode() for k, v in metadata.items()}
+
+    def get_verified_mtime(self) -> str | None:
+        """ Return the mtime at which the source was last found unchanged by its hash, if any """
+        if not os.path.exists(self.path_mtime):
+            return None
+        with open(self.path_mtime) as file:
+            return file.read().strip()
+
+    def is_current(self) -> bool:
+        """ Return whether the cache exists and was built from the current source CSV """
+        if not os.path.exists(self.path_cache):
+            return False
+        metadata = self.get_metadata()
+        stat = os.stat(self.path_csv)
+        if metadata.get("source_size") != str(stat.st_size):
+            return False
+        if str(stat.st_mtime_ns) in [metadata.get("source_mtime"), self.get_verified_mtime()]:
+            return True
+        if metadata.get("source_sha256") != self.get_source_hash():
+            return False
+        # The source was touched but not changed, so its new mtime is recorded to skip the hash next time
+        with open(self.path_mtime, "w") as file:
+            file.write(str(stat.st_mtime_ns))
+        return True
+
+    def build(self) -> None:
+        """ Convert the source CSV to Parquet, streaming it in blocks to bound memory """
+        stat = os.stat(self.path_csv)
+        columns = list(pd.read_csv(self.path_csv, nrows=0).columns)
+        reader = pa_csv.open_csv(
+            self.path_csv,
+            read_options=pa_csv.ReadOptions(block_size=self.block_size),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={col: pa.string() for col in columns}, strings_can_be_null=True))
+        metadata = {
+            "source_size": str(stat.st_size),
+            "source_mtime": str(stat.st_mtime_ns),
+            "source_sha256": self.get_source_hash()
+        }
+        schema = reader.schema.with_metadata(metadata)
+        path_tmp = self.path_cache + ".tmp"
+        with pq.ParquetWriter(path_tmp, schema) as writer:
+            for batch in reader:
+                writer.write_table(pa.Table.from_batches([batch], schema=schema))
+        os.replace(path_tmp, self.path_cache)
+        if os.path.exists(self.path_mtime):
+            os.remove(self.path_mtime)
+
+    def update(self) -> bool:
+        """ Rebuild the cache if it is missing or stale, returning whether it was rebuilt """
+        if self.is_current():
+            return False
+        self.build()
+        return True
+
+    def to_pandas(self, table: pa.Table, dtypes: dict) -> pd.DataFrame:
+        """ Cast string columns to the requested numeric dtypes and convert to a DataFrame """
+        for col, dtype in dtypes.items():
+            if dtype in self.arrow_types and col in table.column_names:
+                i = table.schema.get_field_index(col)
+                table = table.set_column(i, col, table.column(i).cast(self.arrow_types[dtype]))
+        return table.to_pandas(types_mapper=self.pandas_types.get)
+
+    def read(self, columns: list, dtypes: dict | None = None) -> pd.DataFrame:
+        """ Read only the requested columns into a DataFrame, with optional pandas dtypes """
+        dtypes = dtypes or {}
+        categorical = [col for col in columns if dtypes.get(col) == "category"]
+        table = pq.read_table(self.path_cache, columns=columns, read_dictionary=categorical)
+        return self.to_pandas(table, dtypes)
+
+    def iter_chunks(self, columns: list, chunksize: int, dtypes: dict | None = None):
+        """ Yield the requested columns in DataFrames of at most chunksize rows """
+        dtypes = dtypes or {}
+        categorical = [col for col in columns if dtypes.get(col) == "category"]
+        start = 0
+        parquet_file = pq.ParquetFile(self.path_cache, read_dictionary=categorical)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            df = self.to_pandas(pa.Table.from_batches([batch]), dtypes)
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+            yield df
+
+    def get_empty_columns(self, columns: list) -> list:
+        """ Return the requested columns that have no values, using Parquet statistics only """
+        metadata = pq.ParquetFile(self.path_cache).metadata
+        positions = {name: i for i, name in enumerate(metadata.schema.names)}
+        null_counts = dict.fromkeys(columns, 0)
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for col in columns:
+                stats = row_group.column(positions[col]).statistics
+                if stats is None or not stats.has_null_count:
+                    return [col for col in columns if self.read([col])[col].isna().all()]
+                null_counts[col] += stats.null_count
+        return [col for col in columns if null_counts[col] == metadata.num_rows]
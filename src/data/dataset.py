@@ -2,35 +2,84 @@ import numpy as np
 import pandas as pd
 
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import PowerTransformer, StandardScaler
 from sklearn.utils.validation import check_is_fitted
 
 from .build import DataBuilder
-from ..filepaths import PATH_DATA_DIR
+from .preprocess import PreprocessingPlan
+from ..filepaths import PATH_CURRENT_CSV, PATH_DATA_DIR
 from ..utils import camel_case_split
 
 
 class Data:
+    """ 
+    Features are held in one contiguous float32 matrix, with columns ordered by group (demographic, 
+    cognitive, area, thickness, volume), so that each group is a slice of the matrix. Other columns 
+    are kept in a DataFrame, and the two are only combined when df is accessed.
+    """
 
     id_var = 'id'
     target_var = 'class'
 
+    cognitive_feature_names = [
+        "meanReactionTimeTest",
+        "timeTrailMakingTestA",
+        "timeTrailMakingTestB",
+        "correctTowerTest",
+        "correctSymbolDigitTest",
+        "incorrectPairsMatchingTask",
+        "prospectiveMemoryTask",
+        'maxDigitsNumericMemoryTest'
+    ]
+
     def __init__(self, df):
-        self._df = df
+        self._columns = list(df.columns)
+        if self.target_var not in self._columns:
+            self._columns.append(self.target_var)
         self._target = None
-        self.df[self.target_var] = self._target
+        self.demo_feature_names = ['age']
+        self.area_feature_names = self.feature_names_startswith('area')
+        self.thickness_feature_names = self.feature_names_startswith('thickness')
+        self.volume_feature_names = self.feature_names_startswith('volume')
+        self._slices = {}
+        start = 0
+        for group in ['demo', 'cognitive', 'area', 'thickness', 'volume']:
+            stop = start + len(getattr(self, f"{group}_feature_names"))
+            self._slices[group] = slice(start, stop)
+            start = stop
+        self._indices = {name: i for i, name in enumerate(self.feature_names)}
+        self._set_df(df)
+
+    def _set_df(self, df):
+        self._meta = df.drop(self.feature_names + [self.target_var], axis=1, errors='ignore')
+        self._matrix = np.ascontiguousarray(df[self.feature_names].to_numpy(dtype=np.float32))
+
+    def view(self, rows: slice):
+        """ Return a Data object for a slice of rows, which shares this object's feature matrix """
+        data = Data.__new__(Data)
+        data.__dict__.update(self.__dict__)
+        data._meta = self._meta.iloc[rows]
+        data._matrix = self._matrix[rows]
+        data._target = None
+        return data
 
     @property
     def df(self):
-        return self._df
+        """ Return a new frame of the data, so that edits to it are only kept by assigning it back to df """
+        features = pd.DataFrame(self._matrix, columns=self.feature_names, index=self._meta.index)
+        df = pd.concat([self._meta, features], axis=1)
+        df[self.target_var] = self.target
+        return df[self._columns]
 
     @df.setter
     def df(self, new_df):
         if not isinstance(new_df, pd.DataFrame):
             raise TypeError
-        if not list(self.df.columns) == list(new_df.columns):
+        if not list(self.df.columns) == list(new_df.columns) or len(new_df) != len(self._meta):
             raise ValueError
-        self._df = new_df
+        # The features are written into the existing matrix, which a view shares with its parent
+        self._meta = new_df[list(self._meta.columns)]
+        self._matrix[:] = new_df[self.feature_names].to_numpy(dtype=np.float32)
+        self._target = new_df[self.target_var].to_numpy()
 
     @property
     def target(self):
@@ -38,45 +87,24 @@ class Data:
 
     @target.setter
     def target(self, value):
-        if len(value) != len(self.df):
+        if len(value) != len(self._meta):
             raise ValueError
         self._target = value
-        self.df[self.target_var] = value
 
-    def get(self, names):
-        return self.df[names].to_numpy()
-    
     @property
-    def demo_feature_names(self):
-        return ['age']
-    
-    @property
-    def cognitive_feature_names(self):
-        return [
-            "meanReactionTimeTest",
-            "timeTrailMakingTestA",
-            "timeTrailMakingTestB",
-            "correctTowerTest",
-            "correctSymbolDigitTest",
-            "incorrectPairsMatchingTask",
-            "prospectiveMemoryTask",
-            'maxDigitsNumericMemoryTest'
-        ]
+    def matrix(self):
+        return self._matrix
+
+    def get_indices(self, names):
+        return [self._indices[name] for name in names]
+
+    def get(self, names):
+        if all(name in self._indices for name in names):
+            return self._matrix[:, self.get_indices(names)]
+        return self.df[names].to_numpy(dtype=float)
     
     def feature_names_startswith(self, s: str):
-        return [x for x in self.df.columns if x.startswith(s)]
-    
-    @property
-    def area_feature_names(self):
-        return self.feature_names_startswith('area')
-    
-    @property
-    def thickness_feature_names(self):
-        return self.feature_names_startswith('thickness')
-
-    @property
-    def volume_feature_names(self):
-        return self.feature_names_startswith('volume')
+        return [x for x in self._columns if x.startswith(s)]
     
     @property
     def imaging_feature_names(self):
@@ -88,15 +116,15 @@ class Data:
 
     @property
     def cognitive(self):
-        return self.get(self.cognitive_feature_names)
+        return self._matrix[:, self._slices['cognitive']]
     
     @property
     def imaging(self):
-        return self.get(self.imaging_feature_names)
+        return self._matrix[:, self._slices['area'].start:self._slices['volume'].stop]
 
     @property
     def features(self):
-        return self.get(self.feature_names)
+        return self._matrix
 
 
 class Dataset(Data):
@@ -111,17 +139,22 @@ class Dataset(Data):
 
     def __init__(self, df):
         train_data, test_data = train_test_split(df, test_size=0.25, random_state=0)
-        self.train, self.test = Data(train_data), Data(test_data)
+        super().__init__(pd.concat([train_data, test_data]))
+        train, test = self.view(slice(0, len(train_data))), self.view(slice(len(train_data), None))
+        self.train, self.test = train, test
+        self.preprocessing = None
 
     def apply_transformer(self, transformer, vars_to_transform):
         check_is_fitted(transformer)
-        self.train.df[vars_to_transform] = transformer.transform(self.train.df[vars_to_transform])
-        self.test.df[vars_to_transform] = transformer.transform(self.test.df[vars_to_transform])
+        indices = self.get_indices(vars_to_transform)
+        for data in [self.train, self.test]:
+            data.matrix[:, indices] = transformer.transform(data.matrix[:, indices])
 
     def apply_scaler(self, scaler, vars_to_scale):
         check_is_fitted(scaler)
-        self.train.df[vars_to_scale] = scaler.transform(self.train.df[vars_to_scale])
-        self.test.df[vars_to_scale] = scaler.transform(self.test.df[vars_to_scale])
+        indices = self.get_indices(vars_to_scale)
+        for data in [self.train, self.test]:
+            data.matrix[:, indices] = scaler.transform(data.matrix[:, indices])
     
     def summarize_by_class(self):
         if self.target is None:
@@ -133,9 +166,7 @@ class Dataset(Data):
 
     @property
     def df(self):
-        if list(self.train.df.columns) != list(self.test.df.columns):
-            raise AssertionError
-        return pd.concat(objs=[self.train.df, self.test.df])
+        return super().df
 
     @property
     def target(self):
@@ -148,46 +179,54 @@ class Dataset(Data):
         return cls(pd.read_csv(filepath))
 
     @classmethod
-    def load(cls, output_dir=PATH_DATA_DIR):
-        return cls(DataBuilder.load(output_dir=output_dir))
+    def load(cls, output_dir=PATH_DATA_DIR, version=None):
+        return cls(DataBuilder.load(output_dir=output_dir, version=version))
     
     @classmethod
-    def load_patients(cls):
-        data = DataBuilder.load()
-        return cls(data[data['subjectType'] == 'patient'])
+    def load_patients(cls, output_dir=PATH_DATA_DIR, version=None):
+        return cls(DataBuilder.load(output_dir=output_dir, version=version, subject_type='patient'))
     
     @classmethod
-    def load_controls(cls):
-        data = DataBuilder.load()
-        return cls(data[data['subjectType'] == 'control'])
+    def load_controls(cls, output_dir=PATH_DATA_DIR, version=None):
+        return cls(DataBuilder.load(output_dir=output_dir, version=version, subject_type='control'))
     
+    def preprocess(self):
+        """ Fit the preprocessing plan on the training set and apply it to the whole dataset in place """
+        self.preprocessing = PreprocessingPlan([
+            ("standardize", self.cognitive_feature_names, "train"),
+            ("yeo-johnson", self.features_to_transform, "train")
+        ]).fit({"train": self.train})
+        self.preprocessing.apply(self)
+        return self
+
     @classmethod
-    def load_preprocess(cls):
-        data = cls.load()
-        scaler = StandardScaler()
-        scaler.fit(data.train.df[data.cognitive_feature_names])
-        data.apply_scaler(scaler, data.cognitive_feature_names)
-        transformer = PowerTransformer(method='yeo-johnson')
-        transformer.fit(data.train.df[cls.features_to_transform])
-        data.apply_transformer(transformer, cls.features_to_transform)
-        return data
+    def load_preprocess(cls, output_dir=PATH_DATA_DIR, version=None):
+        return cls.load(output_dir=output_dir, version=version).preprocess()
         
     @classmethod
-    def get_sets(cls):
-        
-        controls = Dataset.load_controls()
-        patients = Dataset.load_patients()
-        
-        transformer = PowerTransformer(method='yeo-johnson')
-        transformer.fit(patients.df[cls.features_to_transform])
-        patients.apply_transformer(transformer, cls.features_to_transform)
-        transformer.fit(controls.df[cls.features_to_transform])
-        controls.apply_transformer(transformer, cls.features_to_transform)
-        transformer.fit(controls.df[cls.features_to_transform])
+    def iter_cohort(cls, plan: PreprocessingPlan | str, chunksize: int = 100000, path_csv: str = PATH_CURRENT_CSV, 
+                    group: str | None = None):
+        """ 
+        Yield the features of a fitted preprocessing plan, or of one saved to JSON, for the whole cohort in 
+        the raw extract, transformed by the plan, as float32 arrays of at most chunksize rows
+        """
+        if isinstance(plan, str):
+            plan = PreprocessingPlan.load(plan)
+        for df in DataBuilder.iter_cohort(plan.feature_names, chunksize, path_csv):
+            yield plan.transform(df.to_numpy(dtype=np.float64), group).astype(np.float32)
+
+    @classmethod
+    def get_sets(cls, output_dir=PATH_DATA_DIR, version=None):
         
-        scaler = StandardScaler()
-        scaler.fit(controls.df[controls.cognitive_feature_names])
-        controls.apply_scaler(scaler, controls.cognitive_feature_names)
-        patients.apply_scaler(scaler, patients.cognitive_feature_names)
+        controls = Dataset.load_controls(output_dir=output_dir, version=version)
+        patients = Dataset.load_patients(output_dir=output_dir, version=version)
+
+        plan = PreprocessingPlan([
+            ("yeo-johnson", cls.features_to_transform, None),
+            ("standardize", cls.cognitive_feature_names, "controls")
+        ]).fit({"patients": patients, "controls": controls})
+        plan.apply(patients, "patients")
+        plan.apply(controls, "controls")
+        patients.preprocessing = controls.preprocessing = plan
 
         return patients, controls
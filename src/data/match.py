@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+
+class ControlMatcher:
+    """ Greedy matching of controls to patients, exactly on strata and nearest on a continuous variable """
+
+    def __init__(self, exact: list | None = None, nearest: str = "age", ratio: int = 1,
+                 caliper: float | None = None, replace: bool = False) -> None:
+        if ratio < 1:
+            raise ValueError("Ratio must be a positive integer")
+        self.exact = ["sex"] if exact is None else list(exact)
+        self.nearest = nearest
+        self.ratio = ratio
+        self.caliper = caliper
+        self.replace = replace
+
+    def match(self, patient_df: pd.DataFrame, control_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return a DataFrame with the index labels of each matched patient and control, along with the
+        distance between them on the nearest variable. Diagnostics are stored on the matcher.
+        """
+        pairs = []
+        control_groups = control_df.groupby(self.exact, observed=True).indices
+        all_patient_values = patient_df[self.nearest].to_numpy(dtype=float)
+        all_control_values = control_df[self.nearest].to_numpy(dtype=float)
+        for key, patient_idx in patient_df.groupby(self.exact, observed=True).indices.items():
+            if key not in control_groups:
+                continue
+            control_idx = control_groups[key]
+            patient_values = all_patient_values[patient_idx]
+            control_values = all_control_values[control_idx]
+            if self.replace:
+                matches = self._match_with_replacement(patient_values, control_values)
+            else:
+                matches = self._match_without_replacement(patient_values, control_values)
+            for i, j, distance in matches:
+                pairs.append((patient_df.index[patient_idx[i]], control_df.index[control_idx[j]], distance))
+
+        self.pairs_ = pd.DataFrame(pairs, columns=["patient", "control", "distance"])
+        counts = self.pairs_["patient"].value_counts()
+        self.pairs_ = self.pairs_[self.pairs_["patient"].isin(counts.index[counts == self.ratio])]
+        order = {label: i for i, label in enumerate(patient_df.index)}
+        self.pairs_ = self.pairs_.sort_values("patient", key=lambda x: x.map(order), kind="stable")
+        self.pairs_.reset_index(drop=True, inplace=True)
+        self.compute_diagnostics(patient_df, control_df)
+        return self.pairs_
+
+    def _within_caliper(self, distance: float) -> bool:
+        return self.caliper is None or distance <= self.caliper
+
+    def _match_with_replacement(self, patient_values: np.ndarray, control_values: np.ndarray) -> list:
+        """ Return the nearest controls for each patient, where controls may be reused """
+        order = np.argsort(control_values, kind="stable")
+        sorted_values = control_values[order]
+        positions = np.searchsorted(sorted_values, patient_values)
+        matches = []
+        for i, value in enumerate(patient_values):
+            window = np.arange(max(positions[i] - self.ratio, 0), min(positions[i] + self.ratio, len(sorted_values)))
+            distances = np.abs(sorted_values[window] - value)
+            for k in np.argsort(distances, kind="stable")[:self.ratio]:
+                if self._within_caliper(distances[k]):
+                    matches.append((i, order[window[k]], distances[k]))
+        return matches
+
+    def _match_without_replacement(self, patient_values: np.ndarray, control_values: np.ndarray) -> list:
+        """
+        Greedily match each patient to the closest available control. Controls are sorted once, and
+        the nearest available control on each side of a patient is found with two disjoint-set
+        forests that skip over used controls, so matching takes O(n log n) time overall.
+        """
+        order = np.argsort(control_values, kind="stable")
+        sorted_values = control_values[order]
+        positions = np.searchsorted(sorted_values, patient_values)
+        n = len(sorted_values)
+        next_available = list(range(n + 1))
+        prev_available = list(range(n + 1))
+
+        def find(parent, i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        matches, active = [], list(range(len(patient_values)))
+        for _ in range(self.ratio):
+            still_active = []
+            for i in active:
+                right = find(next_available, positions[i])
+                left = find(prev_available, positions[i]) - 1
+                candidates = []
+                if left >= 0:
+                    candidates.append((patient_values[i] - sorted_values[left], left))
+                if right < n:
+                    candidates.append((sorted_values[right] - patient_values[i], right))
+                if not candidates:
+                    continue
+                distance, j = min(candidates)
+                if not self._within_caliper(distance):
+                    continue
+                next_available[j] = j + 1
+                prev_available[j + 1] = j
+                matches.append((i, order[j], distance))
+                still_active.append(i)
+            active = still_active
+        return matches
+
+    @staticmethod
+    def standardized_mean_difference(x: np.ndarray, y: np.ndarray) -> float:
+        pooled_sd = np.sqrt((np.var(x, ddof=1) + np.var(y, ddof=1)) / 2)
+        if pooled_sd == 0:
+            return 0.0
+        return (np.mean(x) - np.mean(y)) / pooled_sd
+
+    def compute_diagnostics(self, patient_df: pd.DataFrame, control_df: pd.DataFrame) -> None:
+        """ Store standardized mean differences before and after matching, and control reuse counts """
+        matched_patients = patient_df.loc[self.pairs_["patient"].unique()]
+        matched_controls = control_df.loc[self.pairs_["control"]]
+        features = {self.nearest: lambda df: df[self.nearest].to_numpy(dtype=float)}
+        for var in self.exact:
+            for level in pd.concat([patient_df[var], control_df[var]]).dropna().unique():
+                features[f"{var}={level}"] = lambda df, var=var, level=level: (df[var] == level).to_numpy(dtype=float)
+        self.smd_ = pd.DataFrame({
+            name: {
+                "Before": self.standardized_mean_difference(f(patient_df), f(control_df)),
+                "After": self.standardized_mean_difference(f(matched_patients), f(matched_controls))
+            } for name, f in features.items()
+        }).T
+        self.reuse_counts_ = self.pairs_["control"].value_counts()
+        self.summary_ = pd.Series({
+            "Patients": len(patient_df),
+            "Matched patients": len(matched_patients),
+            "Controls": len(control_df),
+            "Matched controls": len(self.reuse_counts_),
+            "Max control reuse": self.reuse_counts_.max() if len(self.reuse_counts_) else 0,
+            "Mean distance": self.pairs_["distance"].mean(),
+            "Max distance": self.pairs_["distance"].max()
+        })
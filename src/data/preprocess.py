@@ -0,0 +1,120 @@
+import json
+
+import numpy as np
+from sklearn.preprocessing import PowerTransformer
+
+
+class PreprocessingPlan:
+    """ Ordered steps of (method, feature names, fitting group), fitted per step and applied in place """
+
+    methods = ["yeo-johnson", "standardize"]
+
+    def __init__(self, steps: list) -> None:
+        for method, _, _ in steps:
+            if method not in self.methods:
+                raise ValueError(f"Method must be one of: {self.methods}")
+        self.steps = [(method, list(names), group) for method, names, group in steps]
+        self.params_ = None
+
+    @property
+    def feature_names(self) -> list:
+        names = []
+        for _, step_names, _ in self.steps:
+            names += [name for name in step_names if name not in names]
+        return names
+
+    def is_fitted(self) -> bool:
+        return self.params_ is not None
+
+    def fit(self, groups: dict):
+        """ Fit each step in turn on the named Data objects, as transformed by the steps before it """
+        buffers = {name: data.get(self.feature_names).astype(np.float64) for name, data in groups.items()}
+        self.params_ = []
+        for method, names, group in self.steps:
+            positions = [self.feature_names.index(name) for name in names]
+            fit_groups = list(groups) if group is None else [group]
+            params = {name: self.fit_step(method, buffers[name][:, positions]) for name in fit_groups}
+            self.params_.append(params)
+            for name in groups:
+                step_params = params[name if group is None else group]
+                buffers[name][:, positions] = self.apply_step(method, buffers[name][:, positions], step_params)
+        return self
+
+    def apply(self, data, group: str | None = None) -> None:
+        """ Apply every step to the feature matrix of a Data object in place """
+        indices = data.get_indices(self.feature_names)
+        data.matrix[:, indices] = self.transform(data.matrix[:, indices], group)
+
+    def transform(self, X: np.ndarray, group: str | None = None) -> np.ndarray:
+        """ Return a float64 copy of X, whose columns are the plan's feature_names, with every step applied """
+        if not self.is_fitted():
+            raise ValueError("Plan must be fitted before it is applied")
+        buffer = X.astype(np.float64)
+        for (method, names, step_group), params in zip(self.steps, self.params_):
+            positions = [self.feature_names.index(name) for name in names]
+            try:
+                step_params = params[group if step_group is None else step_group]
+            except KeyError:
+                raise ValueError(f"Step {method} was not fitted on group: {group}")
+            buffer[:, positions] = self.apply_step(method, buffer[:, positions], step_params)
+        return buffer
+
+    @staticmethod
+    def fit_step(method: str, X: np.ndarray) -> dict:
+        params = {}
+        if method == "yeo-johnson":
+            params["lambdas"] = PowerTransformer(method='yeo-johnson', standardize=False).fit(X).lambdas_
+            X = PreprocessingPlan.yeo_johnson(X, params["lambdas"])
+        scale = X.std(axis=0)
+        params["mean"], params["scale"] = X.mean(axis=0), np.where(scale == 0, 1, scale)
+        return params
+
+    @staticmethod
+    def apply_step(method: str, X: np.ndarray, params: dict) -> np.ndarray:
+        if method == "yeo-johnson":
+            X = PreprocessingPlan.yeo_johnson(X, params["lambdas"])
+        return (X - params["mean"]) / params["scale"]
+
+    @staticmethod
+    def yeo_johnson(X: np.ndarray, lambdas: np.ndarray) -> np.ndarray:
+        """ Yeo-Johnson transform of each column, with the same formula as PowerTransformer """
+        out = np.empty_like(X, dtype=np.float64)
+        for j, lmbda in enumerate(lambdas):
+            x, pos = X[:, j], X[:, j] >= 0
+            if abs(lmbda) < np.spacing(1.0):
+                out[pos, j] = np.log1p(x[pos])
+            else:
+                out[pos, j] = (np.power(x[pos] + 1, lmbda) - 1) / lmbda
+            if abs(lmbda - 2) > np.spacing(1.0):
+                out[~pos, j] = -(np.power(-x[~pos] + 1, 2 - lmbda) - 1) / (2 - lmbda)
+            else:
+                out[~pos, j] = -np.log1p(-x[~pos])
+        return out
+
+    def to_dict(self) -> dict:
+        return {
+            "steps": self.steps,
+            "params": None if self.params_ is None else [
+                {group: {k: np.asarray(v).tolist() for k, v in params.items()} for group, params in step.items()}
+                for step in self.params_
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, dct: dict):
+        plan = cls(dct["steps"])
+        if dct["params"] is not None:
+            plan.params_ = [
+                {group: {k: np.asarray(v) for k, v in params.items()} for group, params in step.items()}
+                for step in dct["params"]
+            ]
+        return plan
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "w") as file:
+            file.write(json.dumps(self.to_dict(), indent=4))
+
+    @classmethod
+    def load(cls, filepath: str):
+        with open(filepath) as file:
+            return cls.from_dict(json.loads(file.read()))
@@ -0,0 +1,43 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+class StageCache:
+    """
+    On-disk cache of the DataFrames produced by named build stages. Each output is keyed by a hash
+    of the stage's config chained with the key of the stage before it, so a change to any stage
+    invalidates that stage and every stage after it, but none of the stages before it.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(*parts) -> str:
+        contents = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha256(contents.encode()).hexdigest()[:16]
+
+    def get_path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{stage}_{key}.pkl")
+
+    def load(self, stage: str, key: str) -> pd.DataFrame | None:
+        """ Return the cached output of a stage, or None if it has not been computed """
+        path = self.get_path(stage, key)
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def save(self, stage: str, key: str, df: pd.DataFrame) -> None:
+        path = self.get_path(stage, key)
+        df.to_pickle(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def clear(self) -> None:
+        """ Remove every cached stage output """
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, filename))
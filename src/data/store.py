@@ -0,0 +1,86 @@
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+class DatasetStore:
+    """ Versioned store of built datasets as Feather files, listed in a JSON manifest """
+
+    manifest_name = "datasets.json"
+
+    def __init__(self, data_dir: str) -> None:
+        self.data_dir = data_dir
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.data_dir, self.manifest_name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def get_manifest(self) -> dict:
+        if not self.exists():
+            return {"latest": None, "versions": {}}
+        with open(self.manifest_path) as file:
+            return json.loads(file.read())
+
+    def write_manifest(self, manifest: dict) -> None:
+        with open(self.manifest_path + ".tmp", "w") as file:
+            file.write(json.dumps(manifest, indent=4))
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def write(self, df: pd.DataFrame, config_hash: str, diagnoses: pd.DataFrame | None = None) -> int:
+        """ Save a dataset, and optionally its diagnosis index, as a new version, returning its version number """
+        manifest = self.get_manifest()
+        version = 1 if manifest["latest"] is None else manifest["latest"] + 1
+        filename = f"dataset_v{version}.feather"
+        self.write_file(df, filename)
+        manifest["versions"][str(version)] = {
+            "filename": filename,
+            "build_date": datetime.now().isoformat(timespec="seconds"),
+            "config_hash": config_hash,
+            "n_rows": len(df)
+        }
+        if diagnoses is not None:
+            manifest["versions"][str(version)]["diagnoses_filename"] = f"dataset_v{version}_diagnoses.feather"
+            self.write_file(diagnoses, f"dataset_v{version}_diagnoses.feather")
+        manifest["latest"] = version
+        self.write_manifest(manifest)
+        return version
+
+    def write_file(self, df: pd.DataFrame, filename: str) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        feather.write_feather(table, os.path.join(self.data_dir, filename), compression="uncompressed")
+
+    def get_entry(self, version: int | None = None) -> dict:
+        """ Return the manifest entry of a version, or of the latest version if none is given """
+        manifest = self.get_manifest()
+        if version is None:
+            version = manifest["latest"]
+        try:
+            return manifest["versions"][str(version)]
+        except KeyError:
+            raise FileNotFoundError(f"Could not find dataset version: {version}")
+
+    def get_filepath(self, version: int | None = None) -> str:
+        return os.path.join(self.data_dir, self.get_entry(version)["filename"])
+
+    def read(self, version: int | None = None, columns: list | None = None) -> pd.DataFrame:
+        """ Read a version of the dataset, memory-mapping the file so that columns are not copied """
+        return self.read_file(self.get_filepath(version), columns)
+
+    def read_diagnoses(self, version: int | None = None) -> pd.DataFrame:
+        """ Read the diagnosis index saved with a version of the dataset """
+        entry = self.get_entry(version)
+        if "diagnoses_filename" not in entry:
+            raise FileNotFoundError(f"No diagnosis index was saved with dataset version: {version}")
+        return self.read_file(os.path.join(self.data_dir, entry["diagnoses_filename"]))
+
+    @staticmethod
+    def read_file(filepath: str, columns: list | None = None) -> pd.DataFrame:
+        table = feather.read_table(filepath, columns=columns, memory_map=True)
+        return table.to_pandas(split_blocks=True)
@@ -28,4 +28,8 @@ def load_variables():
     cognition = load_json(resource_filename(__name__, "cognition.json"))
     imaging = load_json(resource_filename(__name__, "imaging.json"))
 
+    for group, variables in zip(["characteristics", "cognition", "imaging"], [characteristics, cognition, imaging]):
+        for config in variables.values():
+            config["Group"] = group
+
     return characteristics | cognition | imaging
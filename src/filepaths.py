@@ -1,3 +1,5 @@
 PATH_CURRENT_CSV = "/Users/joshua/Developer/CognitiveSubtypes/data/raw/current.csv"
 PATH_DATA_DIR = "/Users/joshua/Developer/CognitiveSubtypes/data"
 PATH_RESULTS_DIR = "/Users/joshua/Developer/CognitiveSubtypes/results"
+PATH_MODELS_DIR = "/Users/joshua/Developer/CognitiveSubtypes/results/models"
+PATH_FIGURES_DIR = "/Users/joshua/Developer/CognitiveSubtypes/results/figures"
@@ -5,6 +5,9 @@ import numpy as np
 from sklearn.base import BaseEstimator
 from sklearn.utils.validation import check_array, check_X_y, NotFittedError
 
+from .store import ModelStore
+from ..filepaths import PATH_MODELS_DIR
+
 
 class BaseModel(ABC):
 
@@ -44,3 +47,16 @@ class BaseModel(ABC):
         for parameter, value in parameters.items():
             setattr(self, parameter, value)
         return self
+
+    def save(self, models_dir: str = PATH_MODELS_DIR, name: str | None = None) -> int:
+        """ Save the fitted model as a new version in the model store, returning its version number """
+        self.check_is_fitted()
+        return ModelStore(models_dir).write(self, name or type(self).__name__)
+
+    @classmethod
+    def load(cls, models_dir: str = PATH_MODELS_DIR, name: str | None = None, version: int | None = None, 
+             mmap_mode: str | None = "r"):
+        model = ModelStore(models_dir).read(name or cls.__name__, version, mmap_mode)
+        if not isinstance(model, cls):
+            raise TypeError(f"Loaded model is a {type(model).__name__}, not a {cls.__name__}")
+        return model
@@ -1,12 +1,22 @@
+import json
+import math
+import os
+import tempfile
 import warnings
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
+import joblib
 import numpy as np
 import pandas as pd
 
+from scipy.stats import loguniform, rankdata, uniform
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn.experimental import enable_halving_search_cv
 from sklearn.linear_model import RidgeClassifier
 from sklearn.metrics import accuracy_score, balanced_accuracy_score, roc_auc_score
+from sklearn.model_selection import check_cv, HalvingRandomSearchCV
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
@@ -15,7 +25,140 @@ from sklearn.utils.validation import check_array, check_is_fitted, NotFittedErro
 
 from skopt import BayesSearchCV
 from skopt.space import Categorical, Integer, Real
+from skopt.utils import point_aslist
 from .base import BaseModel
+from .store import ModelStore
+from ..filepaths import PATH_MODELS_DIR
+from ..utils import memmap
+
+
+class SearchCheckpoint:
+    """ Append-only JSON lines file of the candidates scored by a hyperparameter search """
+
+    def __init__(self, filepath: str, fingerprint: str | None = None) -> None:
+        self.filepath = filepath
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def get_fingerprint(X: np.ndarray, y: np.ndarray, splits: list, scoring: str, search_space: dict) -> str:
+        """ Return a hash of everything a candidate's scores depend on besides its parameters """
+        # Dimensions are hashed by their bounds and prior, as skopt sets their transform in place
+        space = {k: (type(v).__name__, v.bounds, v.prior) for k, v in search_space.items()}
+        return joblib.hash([np.asarray(X), np.asarray(y), [(np.asarray(a), np.asarray(b)) for a, b in splits], 
+                            scoring, space])
+
+    def load(self, search_space: dict | None = None) -> list:
+        """ 
+        Return the evaluated candidates, skipping any that are outside of the search space. If the
+        checkpoint was written for another fingerprint, it is discarded and the search starts afresh.
+        """
+        if not os.path.exists(self.filepath):
+            return []
+        with open(self.filepath) as file:
+            lines = file.readlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            header = None
+        if not isinstance(header, dict) or header.get("fingerprint", False) != self.fingerprint:
+            print(f"Discarding checkpoint written for other data or settings: {self.filepath}")
+            os.remove(self.filepath)
+            return []
+        records = []
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if search_space is not None and (
+                set(record["params"]) != set(search_space) or
+                any(record["params"][k] not in dim for k, dim in search_space.items())
+            ):
+                continue
+            records.append(record)
+        return records
+
+    def append(self, results: dict, n_candidates: int) -> None:
+        """ Append the last n_candidates of a cv_results_ dictionary """
+        n_splits = len([k for k in results if k.startswith("split") and k.endswith("_test_score")])
+        is_new = not os.path.exists(self.filepath)
+        with open(self.filepath, "a") as file:
+            if is_new:
+                file.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+            for i in range(len(results["params"]) - n_candidates, len(results["params"])):
+                file.write(json.dumps({
+                    "params": {k: np.asarray(v).item() for k, v in results["params"][i].items()},
+                    "split_scores": [float(results[f"split{j}_test_score"][i]) for j in range(n_splits)],
+                    "mean_score": float(results["mean_test_score"][i]),
+                    "mean_fit_time": float(results["mean_fit_time"][i])
+                }) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class ResumableBayesSearchCV(BayesSearchCV):
+    """ BayesSearchCV that checkpoints every candidate and resumes from those already checkpointed """
+
+    checkpoint = None
+
+    def fit(self, X, y=None, *, groups=None, callback=None, **fit_params):
+        self.previous_ = [] if self.checkpoint is None else self.checkpoint.load(self.search_spaces)
+        super().fit(X, y, groups=groups, callback=callback, **fit_params)
+        if self.previous_:
+            self.merge_previous()
+            if self.best_index_ < len(self.previous_) and self.refit:
+                self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+                self.best_estimator_.fit(X, y, **fit_params)
+        return self
+
+    def merge_previous(self) -> None:
+        """ Prepend the candidates of earlier runs to cv_results_, and select the best of all candidates """
+        n = len(self.previous_)
+        split_scores = np.array([record["split_scores"] for record in self.previous_])
+        previous = {
+            "mean_test_score": np.array([record["mean_score"] for record in self.previous_]),
+            "std_test_score": split_scores.std(axis=1),
+            "mean_fit_time": np.array([record["mean_fit_time"] for record in self.previous_]),
+            **{f"split{j}_test_score": split_scores[:, j] for j in range(split_scores.shape[1])}
+        }
+        results = {}
+        for key, values in self.cv_results_.items():
+            if key == "params":
+                results[key] = [record["params"] for record in self.previous_] + list(values)
+            elif key.startswith("param_"):
+                column = np.ma.masked_all(n, dtype=object)
+                for i, record in enumerate(self.previous_):
+                    if key[len("param_"):] in record["params"]:
+                        column[i] = record["params"][key[len("param_"):]]
+                results[key] = np.ma.concatenate([column, values])
+            elif key in previous:
+                results[key] = np.concatenate([previous[key], values])
+            else:
+                results[key] = np.concatenate([np.full(n, np.nan), values])
+        scores = np.nan_to_num(results["mean_test_score"], nan=-np.inf)
+        results["rank_test_score"] = rankdata(-scores, method="min").astype(np.int32)
+        self.cv_results_ = results
+        self.best_index_ = int(np.argmin(results["rank_test_score"]))
+        self.best_params_ = results["params"][self.best_index_]
+        self.best_score_ = results["mean_test_score"][self.best_index_]
+
+    def _make_optimizer(self, params_space):
+        optimizer = super()._make_optimizer(params_space)
+        if self.previous_:
+            optimizer.tell(
+                [point_aslist(params_space, record["params"]) for record in self.previous_],
+                [-record["mean_score"] for record in self.previous_]
+            )
+        return optimizer
+
+    def _run_search(self, evaluate_candidates):
+        def evaluate_and_checkpoint(candidate_params, *args, **kwargs):
+            candidate_params = list(candidate_params)
+            results = evaluate_candidates(candidate_params, *args, **kwargs)
+            if self.checkpoint is not None:
+                self.checkpoint.append(results, len(candidate_params))
+            return results
+        super()._run_search(evaluate_and_checkpoint)
 
 
 class BaseClassifier(BaseModel):
@@ -30,8 +173,27 @@ class BaseClassifier(BaseModel):
 
     fs_param_grid = {}
 
-    def __init__(self, score_method: str = 'accuracy') -> None:
+    search_methods = ['bayes', 'halving']
+
+    # Successive halving, if chosen over the default Bayesian search, races n_iter random candidates on 
+    # a growing budget of the resource, which is either the number of training samples or a parameter 
+    # of the pipeline such as n_estimators
+    search_method = 'bayes'
+    halving_resource = 'n_samples'
+    halving_max_resources = 'auto'
+    halving_factor = 3
+
+    # Stop the Bayesian search once the best score has not improved for this many candidates
+    patience = None
+
+    # Fit the preprocessing steps of the pipeline once per fold rather than once per fold for every 
+    # candidate, when the search is Bayesian and no searched parameter belongs to those steps
+    precompute_folds = True
+
+    def __init__(self, score_method: str = 'accuracy', search_method: str | None = None) -> None:
         super().__init__()
+        if search_method is not None:
+            self.search_method = search_method
         self._pipeline = Pipeline([
             ('scaler', StandardScaler()),
             ("clf", self.sklearn_estimator())
@@ -55,6 +217,63 @@ class BaseClassifier(BaseModel):
     def n_iter(self) -> int:
         pass
 
+    def get_search(self, pipeline: Pipeline, n_jobs: int, cv: list, checkpoint: SearchCheckpoint | None = None, 
+                   **kwargs):
+        if self.search_method not in self.search_methods:
+            raise ValueError(f"Search method must be one of: {self.search_methods}")
+        if self.search_method == 'bayes':
+            search = ResumableBayesSearchCV(pipeline, self.param_grid, n_jobs=n_jobs, 
+                                            scoring=self._score_method, n_iter=self.n_iter, cv=cv, **kwargs)
+            if checkpoint is not None:
+                search.checkpoint = checkpoint
+                search.n_iter = max(1, self.n_iter - len(checkpoint.load(self.param_grid)))
+            return search
+        if checkpoint is not None:
+            raise ValueError("Checkpoints are only supported by Bayesian search")
+        kwargs.pop('n_points', None)
+        param_distributions = {
+            k: self.to_distribution(v) for k, v in self.param_grid.items() if k != self.halving_resource
+        }
+        return HalvingRandomSearchCV(pipeline, param_distributions, n_candidates=self.n_iter, 
+                                     factor=self.halving_factor, resource=self.halving_resource, 
+                                     max_resources=self.halving_max_resources, min_resources='exhaust', 
+                                     n_jobs=n_jobs, scoring=self._score_method, cv=cv, **kwargs)
+
+    @staticmethod
+    def to_distribution(dimension):
+        """ Convert a dimension of a skopt search space to a list or scipy distribution """
+        if isinstance(dimension, Categorical):
+            return list(dimension.categories)
+        if isinstance(dimension, Integer):
+            return list(range(dimension.low, dimension.high + 1))
+        if dimension.prior == 'log-uniform':
+            return loguniform(dimension.low, dimension.high)
+        return uniform(dimension.low, dimension.high - dimension.low)
+
+    def can_precompute_folds(self) -> bool:
+        """ Return whether the preprocessing steps of the pipeline can be fitted once per fold """
+        preprocessing = [name for name, _ in self.pipeline.steps[:-1]]
+        return self.precompute_folds and self.search_method == 'bayes' and len(preprocessing) > 0 and not any(
+            k.split('__')[0] in preprocessing for k in self.param_grid)
+
+    def get_precomputed_folds(self, X: np.ndarray, y: np.ndarray, splits: list) -> tuple:
+        """
+        Return the final step of the pipeline, X transformed by the preprocessing steps fitted on each
+        training fold and stacked fold by fold, y repeated to match, and the splits offset to the stack
+        """
+        preprocessing = self.pipeline[:-1]
+        X_folds, fold_splits = [], []
+        for i, (train, test) in enumerate(splits):
+            X_folds.append(clone(preprocessing).fit(X[train], y[train]).transform(X))
+            fold_splits.append((train + i * len(X), test + i * len(X)))
+        return Pipeline(self.pipeline.steps[-1:]), np.concatenate(X_folds), np.tile(y, len(splits)), fold_splits
+
+    def get_plateau_callback(self):
+        """ Return a skopt callback that stops the search when the best score plateaus """
+        def callback(result):
+            return len(result.func_vals) - 1 - np.argmin(result.func_vals) >= self.patience
+        return callback
+
     @property
     def pipeline(self) -> Pipeline:
         return self._pipeline
@@ -72,33 +291,52 @@ class BaseClassifier(BaseModel):
             return False
         return True
 
-    def fit(self, X: np.ndarray, y: np.ndarray, surpress_warnings = True, **kwargs) -> None:
+    def fit(self, X: np.ndarray, y: np.ndarray, surpress_warnings = True, n_jobs: int = -1, cv: int = 5, 
+            checkpoint: str | None = None, **kwargs) -> None:
+        """
+        Search the hyperparameters of the pipeline on CV splits computed once, on folds preprocessed once
+        where possible. With a checkpoint file, a Bayesian search records each candidate as it is scored, 
+        and resumes from those recorded.
+        """
         super().fit(X, y)
         if self._score_method not in self.available_metrics.keys():
             raise ValueError(f"Scoring must be one of: {self.available_metrics.keys()}")
-        self.grid_ = BayesSearchCV(
-            self.pipeline,
-            self.param_grid,
-            n_jobs=-1,
-            scoring=self._score_method,
-            n_iter=self.n_iter,
-            cv=5,
-            **kwargs)
-        print("Begin fitting best classifier for model: " + str(self))
-        if surpress_warnings:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                self.grid_.fit(X, y)
+        splits = list(check_cv(cv, y, classifier=True).split(X, y))
+        if checkpoint is not None:
+            fingerprint = SearchCheckpoint.get_fingerprint(X, y, splits, self._score_method, self.param_grid)
+            checkpoint = SearchCheckpoint(checkpoint, fingerprint)
+        precomputed = self.can_precompute_folds() and kwargs.get('refit', True) is True
+        if precomputed:
+            pipeline, X_search, y_search, search_splits = self.get_precomputed_folds(X, y, splits)
+            kwargs['refit'] = False
         else:
-            self.grid_.fit(X, y)
+            pipeline, X_search, y_search, search_splits = self.pipeline, X, y, splits
+        self.grid_ = self.get_search(pipeline, n_jobs, search_splits, checkpoint, **kwargs)
+        fit_params = {}
+        if self.search_method == 'bayes' and self.patience is not None:
+            fit_params['callback'] = self.get_plateau_callback()
+        # The search's verbose argument also silences these messages, as when models are fitted concurrently
+        verbose = kwargs.get('verbose', True)
+        if verbose:
+            print("Begin fitting best classifier for model: " + str(self))
+        with warnings.catch_warnings():
+            if surpress_warnings:
+                warnings.simplefilter("ignore")
+            self.grid_.fit(X_search, y_search, **fit_params)
+            if precomputed:
+                # The best parameters are refit with the whole pipeline, on the data as given
+                self.grid_.estimator = self.pipeline
+                self.grid_.best_estimator_ = clone(self.pipeline).set_params(**self.grid_.best_params_).fit(X, y)
+                self.grid_.refit = True
         self.n_targets_ = len(np.unique(y))
         self.best_estimator_ = self.grid_.best_estimator_
         self.best_params_ = self.grid_.best_params_
         self.best_score_ = self.grid_.best_score_
         self.classes_ = self.grid_.classes_
         self.n_features_in_ = self.grid_.n_features_in_
-        print("Done!")
-        print(f"{self._score_method}: {self.best_score_}")
+        if verbose:
+            print("Done!")
+            print(f"{self._score_method}: {self.best_score_}")
 
     def predict(self, X: np.ndarray) -> None:
         self.check_is_fitted()
@@ -139,6 +377,7 @@ class BestSVC(BaseClassifier):
         'clf__probability': Categorical([True])
     }
     n_iter = 50
+    patience = 15
 
 
 class BestRidgeClassifier(BaseClassifier):
@@ -161,6 +400,9 @@ class BestRandomForestClassifier(BaseClassifier):
         'clf__class_weight': Categorical(['balanced'])
     }
     n_iter = 40
+    patience = 10
+    halving_resource = 'clf__n_estimators'
+    halving_max_resources = 500
 
 
 class BestGradientBoostingClassifier(BaseClassifier):
@@ -176,28 +418,73 @@ class BestGradientBoostingClassifier(BaseClassifier):
         "clf__subsample": Real(0.5, 1, 'log-uniform')
     }
     n_iter = 50
+    patience = 15
 
 
 class ClassifierSearch:
+    """ Fits the candidate classifiers concurrently, sharing one budget of n_jobs workers """
     
-    def __init__(self):
-        self.classifiers = []
-        for clf in [BestKNeighborsClassifier, BestRidgeClassifier, BestRandomForestClassifier]:
-            self.classifiers.append(clf(score_method='roc_auc'))
+    def __init__(self, n_jobs: int = -1, cv: int = 5, checkpoint_dir: str | None = None, 
+                 search_methods: dict | None = None):
         self.model_names = ['KNN', 'RDG', 'RFC']
+        search_methods = {} if search_methods is None else search_methods
+        if not set(search_methods) <= set(self.model_names):
+            raise ValueError(f"Search methods must be keyed by model name: {self.model_names}")
+        self.classifiers = []
+        for clf, name in zip([BestKNeighborsClassifier, BestRidgeClassifier, BestRandomForestClassifier], self.model_names):
+            self.classifiers.append(clf(score_method='roc_auc', search_method=search_methods.get(name)))
         self.roc_auc_scores = None
-        
+        self.n_jobs = n_jobs
+        self.cv = cv
+        self.checkpoint_dir = checkpoint_dir
+
+    def get_checkpoint(self, clf, name: str) -> str | None:
+        if self.checkpoint_dir is None or clf.search_method != 'bayes':
+            return None
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        return os.path.join(self.checkpoint_dir, f"{name}.jsonl")
+
     def fit(self, data):
         self.roc_auc_scores = {"Train": [], "Test": []}
+        n_jobs = joblib.effective_n_jobs(self.n_jobs)
+        n_points = max(1, math.ceil(n_jobs / (self.cv * len(self.classifiers))))
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+            x_train = memmap(data.train.imaging, temp_dir, "x_train")
+            y_train = memmap(data.train.target, temp_dir, "y_train")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                with ThreadPoolExecutor(max_workers=len(self.classifiers)) as executor:
+                    futures = [
+                        executor.submit(clf.fit, x_train, y_train, surpress_warnings=False, n_jobs=n_jobs,
+                                        n_points=n_points, cv=self.cv, checkpoint=self.get_checkpoint(clf, name), 
+                                        verbose=False)
+                        for clf, name in zip(self.classifiers, self.model_names)
+                    ]
+                    print("Begin fitting best classifiers for models: " + ", ".join(self.model_names))
+                    for future, name, clf in zip(futures, self.model_names, self.classifiers):
+                        future.result()
+                        print(f"Done {name}! roc_auc: {clf.best_score_}")
+        x_test = data.test.imaging
         for clf in self.classifiers:
-            x_train = data.train.df[data.imaging_feature_names].to_numpy()
-            x_test = data.test.df[data.imaging_feature_names].to_numpy()
-            clf.fit(x_train, data.train.target, surpress_warnings=True, verbose=False)
             self.roc_auc_scores["Train"].append(clf.best_score_)
             self.roc_auc_scores["Test"].append(clf.score(x_test, data.test.target))
         self.roc_auc_scores = pd.DataFrame(self.roc_auc_scores, index=self.model_names)
         self.best_classifier = self.classifiers[self.model_names.index(self.roc_auc_scores["Test"].idxmax())]
 
+    def save(self, models_dir: str = PATH_MODELS_DIR, name: str = "ClassifierSearch") -> int:
+        """ Save the fitted searches and scores as a new version in the model store """
+        if self.roc_auc_scores is None:
+            raise NotFittedError("Object must be fitted before method call")
+        return ModelStore(models_dir).write(self, name)
+
+    @classmethod
+    def load(cls, models_dir: str = PATH_MODELS_DIR, name: str = "ClassifierSearch", version: int | None = None, 
+             mmap_mode: str | None = "r"):
+        cs = ModelStore(models_dir).read(name, version, mmap_mode)
+        if not isinstance(cs, cls):
+            raise TypeError(f"Loaded model is a {type(cs).__name__}, not a {cls.__name__}")
+        return cs
+
   
 def get_feature_importances(best_random_forest, feature_names):
     
@@ -1,12 +1,21 @@
+import os
+import tempfile
+
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score, calinski_harabasz_score, davies_bouldin_score, silhouette_score
+from sklearn.metrics.cluster import contingency_matrix
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils import check_random_state, get_chunk_n_rows
 
 from .base import BaseModel
-from ..utils import get_array_counts
+from ..utils import get_array_counts, memmap
 
 
 class BestKMeans(BaseModel):
+    """ Fits and scores KMeans for each k from k_min to k_max, in memory or on a stream of chunks """
 
     sklearn_estimator = KMeans
 
@@ -16,24 +25,111 @@ class BestKMeans(BaseModel):
         "silhouette": silhouette_score
     }
 
-    def __init__(self, k_min: int = 2, k_max: int = 6):
+    # Memory, in MiB, of each chunk of the distance matrix used for the silhouette coefficient
+    working_memory = 256
+
+    def __init__(self, k_min: int = 2, k_max: int = 6, n_jobs: int | None = None,
+                 silhouette_sample_size: int | None = None, random_state: int | None = None):
         super().__init__()
         self._estimator = self.sklearn_estimator
         self._k_min = k_min
         self._k_max = k_max
+        self._n_jobs = n_jobs
+        self._silhouette_sample_size = silhouette_sample_size
+        self._random_state = random_state
 
     def fit(self, X: np.ndarray, y: None = None) -> None:
         super().fit(X, y)
+        k_values = list(range(self._k_min, self._k_max + 1))
+        models = Parallel(n_jobs=self._n_jobs, prefer="threads")(
+            delayed(self._estimator(n_clusters=k, random_state=self._random_state).fit)(X) for k in k_values
+        )
+        self.set_scores(X, k_values, models, [model.labels_ for model in models])
+
+    def fit_stream(self, get_chunks, n_passes: int = 3, reservoir_size: int = 10000) -> None:
+        """
+        Fit on a stream of chunks of rows, where get_chunks returns a new iterator over the chunks
+        for each pass, e.g. lambda: Dataset.iter_cohort(data.preprocessing) for the preprocessed 
+        cognitive features of the whole cohort. Only one chunk and the reservoir sample are held in memory.
+        """
+        rng = check_random_state(self._random_state)
+        k_values = list(range(self._k_min, self._k_max + 1))
+        models = [MiniBatchKMeans(n_clusters=k, random_state=self._random_state, n_init=3) for k in k_values]
+        sample, n_seen = None, 0
+        with Parallel(n_jobs=self._n_jobs, prefer="threads") as parallel:
+            for i in range(n_passes):
+                for chunk in get_chunks():
+                    chunk = chunk[~np.isnan(chunk).any(axis=1)]
+                    if len(chunk) == 0:
+                        continue
+                    if i == 0:
+                        sample, n_seen = self.update_reservoir(sample, n_seen, chunk, reservoir_size, rng)
+                    parallel(delayed(model.partial_fit)(chunk) for model in models)
+        if sample is None:
+            raise ValueError("Stream did not contain any complete rows")
+        super().fit(sample)
+        self.n_samples_seen_ = n_seen
+        self.set_scores(sample, k_values, models, [model.predict(sample) for model in models])
+
+    def set_scores(self, X: np.ndarray, k_values: list, models: list, labels: list) -> None:
+        labels = dict(zip(k_values, labels))
+        silhouettes = self.silhouette_scores(X, labels)
         self.models_ = {}
         self.scores_ = {}
-        for k in range(self._k_min, self._k_max + 1):
-            model, model_name = self._estimator(n_clusters=k), k
-            y_pred = model.fit_predict(X)
-            self.models_[model_name] = model
-            self.scores_[model_name] = {
-                name: metric(X, y_pred) for name, metric in self.available_metrics.items()
+        for k, model in zip(k_values, models):
+            self.models_[k] = model
+            self.scores_[k] = {
+                name: silhouettes[k] if name == "silhouette" else metric(X, labels[k])
+                for name, metric in self.available_metrics.items()
             }
 
+    @staticmethod
+    def update_reservoir(sample: np.ndarray | None, n_seen: int, chunk: np.ndarray, size: int, rng) -> tuple:
+        """ Add a chunk of rows to a uniform reservoir sample of at most size rows (Algorithm R) """
+        n_fill = 0 if sample is None else max(size - len(sample), 0)
+        if sample is None:
+            sample, n_fill = chunk[:size].copy(), min(size, len(chunk))
+        elif n_fill:
+            sample = np.concatenate([sample, chunk[:n_fill]])
+        rest = chunk[n_fill:]
+        positions = n_seen + n_fill + np.arange(len(rest))
+        replace = rng.randint(0, positions + 1) if len(rest) else positions
+        keep = replace < size
+        # Rows are considered in order, so when two rows draw the same slot, the later one is kept
+        slots, last = np.unique(replace[keep][::-1], return_index=True)
+        sample[slots] = rest[keep][::-1][last]
+        return sample, n_seen + len(chunk)
+
+    def silhouette_scores(self, X: np.ndarray, labels: dict) -> dict:
+        """ Return the mean silhouette coefficient of each labelling of X, keyed as the labels are """
+        if self._silhouette_sample_size is not None and self._silhouette_sample_size < len(X):
+            rng = check_random_state(self._random_state)
+            indices = rng.permutation(len(X))[:self._silhouette_sample_size]
+            X, labels = X[indices], {k: y_pred[indices] for k, y_pred in labels.items()}
+        X = np.asarray(X, dtype=np.float64)
+
+        # For each labelling, a one-hot matrix of cluster memberships, so that the distance from each
+        # row to every cluster is one product with a chunk of the distance matrix
+        memberships = {k: np.eye(y_pred.max() + 1)[y_pred] for k, y_pred in labels.items()}
+        sums = {k: np.empty_like(m) for k, m in memberships.items()}
+        chunk_size = get_chunk_n_rows(row_bytes=8 * len(X), max_n_rows=len(X), working_memory=self.working_memory)
+        for start in range(0, len(X), chunk_size):
+            distances = euclidean_distances(X[start:start + chunk_size], X)
+            for k, m in memberships.items():
+                sums[k][start:start + chunk_size] = distances @ m
+
+        scores = {}
+        for k, y_pred in labels.items():
+            counts = memberships[k].sum(axis=0)
+            rows = np.arange(len(y_pred))
+            a = sums[k][rows, y_pred] / np.maximum(counts[y_pred] - 1, 1)
+            mean_distances = np.divide(sums[k], counts, out=np.full_like(sums[k], np.inf), where=counts > 0)
+            mean_distances[rows, y_pred] = np.inf
+            b = mean_distances.min(axis=1)
+            s = np.where(counts[y_pred] > 1, (b - a) / np.maximum(a, b), 0)
+            scores[k] = float(np.mean(np.nan_to_num(s)))
+        return scores
+
     def is_fitted(self) -> bool:
         if self.models_ is None or self.scores_ is None:
             return False
@@ -45,3 +141,68 @@ class BestKMeans(BaseModel):
         if return_counts:
             return get_array_counts(y_pred)
         return y_pred
+
+
+class ClusterStability:
+    """ Bootstrap stability of the KMeans solution for each k, by ARI and Jaccard index with a reference clustering """
+
+    # Resamples are run on the process pool, and appended to results_path, in blocks of this many
+    block_size = 32
+
+    def __init__(self, k_min: int = 2, k_max: int = 6, n_resamples: int = 100, n_jobs: int = -1,
+                 random_state: int | None = None, results_path: str | None = None) -> None:
+        self.k_values = list(range(k_min, k_max + 1))
+        self.n_resamples = n_resamples
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.results_path = results_path
+
+    def fit(self, X: np.ndarray, reference: BestKMeans | None = None):
+        """ Compute the stability of each k, using the clusterings of a fitted BestKMeans if given """
+        if reference is None:
+            reference = BestKMeans(self.k_values[0], self.k_values[-1], self.n_jobs, random_state=self.random_state)
+            reference.fit(X)
+        reference_labels = np.column_stack([reference.predict(X, k) for k in self.k_values])
+        # Each resample has its own seed, so results do not depend on n_jobs or the order workers finish in
+        seeds = np.random.SeedSequence(self.random_state).spawn(self.n_resamples)
+        if self.results_path is not None and os.path.exists(self.results_path):
+            os.remove(self.results_path)
+        results = []
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+            X = memmap(X, temp_dir, "X")
+            with Parallel(n_jobs=self.n_jobs) as parallel:
+                for start in range(0, self.n_resamples, self.block_size):
+                    block = parallel(
+                        delayed(self.resample)(X, reference_labels, self.k_values, i, seeds[i])
+                        for i in range(start, min(start + self.block_size, self.n_resamples))
+                    )
+                    block = pd.DataFrame([record for records in block for record in records])
+                    if self.results_path is not None:
+                        block.to_csv(self.results_path, mode="a", index=False, header=start == 0)
+                    results.append(block)
+        self.results_ = pd.concat(results, ignore_index=True)
+        self.scores_ = self.results_.groupby("k")[["ari", "jaccard"]].agg(["mean", "std"])
+        return self
+
+    @staticmethod
+    def resample(X: np.ndarray, reference_labels: np.ndarray, k_values: list, resample: int, seed) -> list:
+        rng = np.random.default_rng(seed)
+        indices = rng.integers(0, len(X), len(X))
+        rows, first = np.unique(indices, return_index=True)
+        random_state = int(rng.integers(2 ** 31 - 1))
+        X_resample = X[indices]
+        records = []
+        for j, k in enumerate(k_values):
+            y_pred = KMeans(n_clusters=k, random_state=random_state).fit_predict(X_resample)[first]
+            y_true = reference_labels[rows, j]
+            overlap = contingency_matrix(y_true, y_pred)
+            union = overlap.sum(axis=1)[:, None] + overlap.sum(axis=0)[None, :] - overlap
+            jaccard = (overlap / union).max(axis=1)
+            records.append({
+                "resample": resample,
+                "k": k,
+                "ari": adjusted_rand_score(y_true, y_pred),
+                "jaccard": jaccard.mean(),
+                **{f"jaccard_{c}": value for c, value in zip(np.unique(y_true), jaccard)}
+            })
+        return records
@@ -0,0 +1,67 @@
+import json
+import os
+from datetime import datetime
+
+import joblib
+
+
+class ModelStore:
+    """
+    Versioned store of fitted models. Each version of a named model is a joblib file listed in a
+    JSON manifest, along with the date it was saved and the class of the model. Files are written
+    without compression, so that the numpy arrays in a model (training matrices, cluster centers,
+    trees) are memory-mapped on load rather than read into memory.
+    """
+
+    manifest_name = "models.json"
+
+    def __init__(self, models_dir: str) -> None:
+        self.models_dir = models_dir
+        os.makedirs(models_dir, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.models_dir, self.manifest_name)
+
+    def get_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as file:
+            return json.loads(file.read())
+
+    def write_manifest(self, manifest: dict) -> None:
+        with open(self.manifest_path + ".tmp", "w") as file:
+            file.write(json.dumps(manifest, indent=4))
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def write(self, model, name: str) -> int:
+        """ Save a model as a new version under a name, returning its version number """
+        manifest = self.get_manifest()
+        entries = manifest.setdefault(name, {"latest": None, "versions": {}})
+        version = 1 if entries["latest"] is None else entries["latest"] + 1
+        filename = f"{name}_v{version}.joblib"
+        joblib.dump(model, os.path.join(self.models_dir, filename))
+        entries["versions"][str(version)] = {
+            "filename": filename,
+            "save_date": datetime.now().isoformat(timespec="seconds"),
+            "class": type(model).__name__
+        }
+        entries["latest"] = version
+        self.write_manifest(manifest)
+        return version
+
+    def get_entry(self, name: str, version: int | None = None) -> dict:
+        """ Return the manifest entry of a version of a model, or of its latest version if none is given """
+        manifest = self.get_manifest()
+        try:
+            entries = manifest[name]
+            return entries["versions"][str(entries["latest"] if version is None else version)]
+        except KeyError:
+            raise FileNotFoundError(f"Could not find model {name} with version: {version}")
+
+    def get_filepath(self, name: str, version: int | None = None) -> str:
+        return os.path.join(self.models_dir, self.get_entry(name, version)["filename"])
+
+    def read(self, name: str, version: int | None = None, mmap_mode: str | None = "r"):
+        """ Load a version of a model, memory-mapping its arrays read-only by default """
+        return joblib.load(self.get_filepath(name, version), mmap_mode=mmap_mode)
@@ -1,6 +1,8 @@
 import json
+import os
 import re
 
+import joblib
 import numpy as np
 import pandas as pd
 
@@ -62,3 +64,10 @@ def flatten_list(list_of_lists: list) -> list:
         for item in sublist:
             flattened_list.append(item)
     return flattened_list
+
+
+def memmap(X: np.ndarray, dirname: str, name: str) -> np.memmap:
+    """ Dump an array to a file and reopen it read-only, so that worker processes map it from disk """
+    filename = os.path.join(dirname, f"{name}.mmap")
+    joblib.dump(np.ascontiguousarray(X), filename)
+    return joblib.load(filename, mmap_mode='r')
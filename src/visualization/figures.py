@@ -1,26 +1,92 @@
 from abc import ABC, abstractmethod
 import os
 
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.figure
+import numpy as np
 import pandas as pd
 import seaborn as sns
+from joblib import Parallel, delayed
 
 from yellowbrick.classifier import ROCAUC
 from yellowbrick.model_selection import FeatureImportances
 
 from ..data.dataset import Dataset
-from ..filepaths import PATH_RESULTS_DIR
+from ..filepaths import PATH_DATA_DIR, PATH_FIGURES_DIR
 from ..utils import camel_case_split
 
 
 class Figure(ABC):
+    """ Figure drawn on its own matplotlib Figure, not registered with pyplot, so it is freed once closed """
+
+    dpi = 300
+    formats = ["png"]
+    fig = None
 
     @abstractmethod
     def plot(self):
         pass
 
-    def save(self, filename):
-        plt.savefig(os.path.join(PATH_RESULTS_DIR, "figures", filename), dpi=300, bbox_inches='tight')
+    def new_figure(self, **kwargs) -> matplotlib.figure.Figure:
+        """ Close the current figure, if any, and start a new one, passing kwargs to Figure """
+        self.close()
+        self.fig = matplotlib.figure.Figure(**kwargs)
+        return self.fig
+
+    def save(self, filename: str, formats: list | None = None, output_dir: str = PATH_FIGURES_DIR) -> list:
+        """ 
+        Save the figure in each format, returning the paths written. If no formats are given, the
+        extension of the filename is used, or the default formats if it has none.
+        """
+        if self.fig is None:
+            raise ValueError("Figure must be plotted before it is saved")
+        root, ext = os.path.splitext(filename)
+        if formats is None:
+            formats = [ext[1:]] if ext else self.formats
+        filepaths = [os.path.join(output_dir, f"{root}.{fmt}") for fmt in formats]
+        for filepath in filepaths:
+            self.fig.savefig(filepath, dpi=self.dpi, bbox_inches='tight')
+        return filepaths
+
+    def close(self) -> None:
+        if self.fig is not None:
+            self.fig.clear()
+            self.fig = None
+
+    def render(self, filename: str, formats: list | None = None, output_dir: str = PATH_FIGURES_DIR) -> list:
+        """ Plot, save and close the figure, returning the paths written """
+        try:
+            self.plot()
+            return self.save(filename, formats, output_dir)
+        finally:
+            self.close()
+
+
+class RenderQueue:
+    """ Queue of figures rendered in a process pool on the Agg backend, each closed once it is saved """
+
+    def __init__(self, formats: list | None = None, output_dir: str = PATH_FIGURES_DIR, n_jobs: int = -1) -> None:
+        self.formats = formats
+        self.output_dir = output_dir
+        self.n_jobs = n_jobs
+        self.specs = []
+
+    def add(self, figure: Figure, filename: str):
+        self.specs.append((figure, filename))
+        return self
+
+    def render(self) -> list:
+        """ Render every queued figure, emptying the queue and returning the paths written by each """
+        os.makedirs(self.output_dir, exist_ok=True)
+        specs, self.specs = self.specs, []
+        return Parallel(n_jobs=self.n_jobs)(
+            delayed(self.render_figure)(figure, filename, self.formats, self.output_dir) for figure, filename in specs
+        )
+
+    @staticmethod
+    def render_figure(figure: Figure, filename: str, formats: list | None, output_dir: str) -> list:
+        matplotlib.use("Agg")
+        return figure.render(filename, formats, output_dir)
 
 
 class KMeansScores(Figure):
@@ -35,7 +101,8 @@ class KMeansScores(Figure):
         silhouette_values = [x['silhouette'] for x in self.model.scores_.values()]
         assert len(k_values) == len(calinski_harabasz_values) == len(silhouette_values)
 
-        fig, ax1 = plt.subplots()
+        fig = self.new_figure()
+        ax1 = fig.subplots()
 
         color = 'tab:red'
         ax1.set_xlabel('Number of Clusters')
@@ -62,7 +129,8 @@ class AUCScores(Figure):
         self.cs = cs
 
     def plot(self):
-        fig, axes = plt.subplots(ncols=2, sharey=True, figsize=(10, 4))
+        fig = self.new_figure(figsize=(10, 4))
+        axes = fig.subplots(ncols=2, sharey=True)
         p1 = axes[0].bar(self.cs.model_names, self.cs.roc_auc_scores["Train"], align='center', alpha=1, color="#408ec6")
         axes[0].bar_label(p1, label_type='edge', fmt='%.2f')
         axes[0].set_title("Training")
@@ -82,32 +150,86 @@ class ROCCurve(Figure):
         self.data = data
     
     def plot(self):
-        viz = ROCAUC(self.cs.best_classifier.best_estimator_, binary=True, title=" ")
+        fig = self.new_figure()
+        viz = ROCAUC(self.cs.best_classifier.best_estimator_, binary=True, title=" ", ax=fig.subplots(), fig=fig)
         viz.fit(self.data.train.imaging, self.data.train.target)
         viz.score(self.data.test.imaging, self.data.test.target)
         viz.finalize()
 
 
-class Transforms(Figure):
+class DistributionFigure(Figure):
+    """ Figure drawn from histograms and KDE grids precomputed per variable and group, not from the rows """
+
+    max_bins = 50
+    gridsize = 100
+    kde_bins = 400
+    cut = 2
+    max_samples = None
+    random_state = 0
+
+    @classmethod
+    def histogram(cls, x: np.ndarray) -> tuple:
+        """ 
+        Return the counts and bin edges of the non-missing values of x, with numpy's automatic 
+        number of bins, as with seaborn's histplot, up to max_bins
+        """
+        x = x[~np.isnan(x)]
+        edges = np.histogram_bin_edges(x, bins="auto")
+        return np.histogram(x, bins=edges if len(edges) <= cls.max_bins + 1 else cls.max_bins)
+
+    @classmethod
+    def kde(cls, x: np.ndarray) -> tuple:
+        """ 
+        Return the support and density of a Gaussian KDE of x with Scott's bandwidth, as with 
+        seaborn's violinplot, binning x into kde_bins bins over the support
+        """
+        x = x[~np.isnan(x)]
+        bw = x.std(ddof=1) * len(x) ** (-1 / 5) if len(x) > 1 else 0
+        if bw == 0:
+            return x[:1], np.ones(min(len(x), 1))
+        support = np.linspace(x.min() - cls.cut * bw, x.max() + cls.cut * bw, cls.gridsize)
+        # Smoothing the counts in fine bins costs the same however many rows there are
+        counts, edges = np.histogram(x, bins=cls.kde_bins, range=(support[0], support[-1]))
+        centers = (edges[:-1] + edges[1:]) / 2
+        kernel = np.exp(-0.5 * np.square((support[:, None] - centers[None, :]) / bw))
+        return support, kernel @ counts / (len(x) * bw * np.sqrt(2 * np.pi))
+
+    def subsample(self, groups: np.ndarray) -> np.ndarray:
+        """ Return the indices of a stratified subsample of at most max_samples rows, in order """
+        if self.max_samples is None or self.max_samples >= len(groups):
+            return np.arange(len(groups))
+        rng = np.random.default_rng(self.random_state)
+        _, codes, counts = np.unique(groups, return_inverse=True, return_counts=True)
+        sizes = np.maximum(np.round(counts * self.max_samples / len(groups)).astype(int), 1)
+        indices = [rng.choice(np.flatnonzero(codes == i), size, replace=False) for i, size in enumerate(sizes)]
+        return np.sort(np.concatenate(indices))
+
+
+class Transforms(DistributionFigure):
+
+    def __init__(self, output_dir: str = PATH_DATA_DIR, version: int | None = None) -> None:
+        self.output_dir = output_dir
+        self.version = version
 
     def plot(self):
 
-        raw_data = Dataset.load()
-        transformed_data = Dataset.load_preprocess()
+        data = Dataset.load(self.output_dir, self.version)
+        raw = data.cognitive.copy()
+        transformed = data.preprocess().cognitive
 
-        variables = raw_data.cognitive_feature_names
+        variables = data.cognitive_feature_names
         nrows = len(variables)
-        fig, axes = plt.subplots(nrows=nrows, ncols=2)
-        
-        for i in range(nrows):
-            sns.histplot(data=raw_data.df, x=variables[i], ax=axes[i][0])
-            axes[i][0].set(xlabel=camel_case_split(variables[i]))
-            axes[i][0].set_ylabel(None)
+        fig = self.new_figure()
+        axes = fig.subplots(nrows=nrows, ncols=2)
+        color = sns.color_palette()[0]
         
-        for i in range(nrows):
-            sns.histplot(data=transformed_data.df, x=variables[i], ax=axes[i][1])
-            axes[i][1].set(xlabel=camel_case_split(variables[i]))
-            axes[i][1].set_ylabel(None)
+        for j, matrix in enumerate([raw, transformed]):
+            for i in range(nrows):
+                counts, edges = self.histogram(matrix[:, i])
+                axes[i][j].bar(edges[:-1], counts, width=np.diff(edges), align="edge", color=color, alpha=.75,
+                               edgecolor=color, linewidth=.5)
+                axes[i][j].set(xlabel=camel_case_split(variables[i]))
+                axes[i][j].set_ylabel(None)
         
         fig.subplots_adjust(wspace=0)
         fig.set_figwidth(8)
@@ -115,7 +237,10 @@ class Transforms(Figure):
         fig.tight_layout()
 
 
-class ViolinPlot(Figure):
+class ViolinPlot(DistributionFigure):
+
+    width = 0.8
+    linewidth = 1.5
 
     def __init__(self, data) -> None:
         self.data = data
@@ -137,18 +262,39 @@ class ViolinPlot(Figure):
         }
 
         variables = self.data.cognitive_feature_names
+        df = self.data.df
+        x_codes, x_levels = pd.factorize(df[x], sort=True)
+        hue_codes, hue_levels = pd.factorize(df[hue])
+        groups = x_codes * len(hue_levels) + hue_codes
+        rows = self.subsample(groups)
+        matrix, groups = df[variables].to_numpy(dtype=float)[rows], groups[rows]
+        masks = {
+            (j, k): groups == j * len(hue_levels) + k for j in range(len(x_levels)) for k in range(len(hue_levels[:2]))
+        }
+        colors = [sns.desaturate(color, .75) for color in sns.color_palette('colorblind')]
 
-        fig, axes = plt.subplots(ncols=4, nrows=2, sharey=True, figsize=(12, 8))
+        fig = self.new_figure(figsize=(12, 8))
+        axes = fig.subplots(ncols=4, nrows=2, sharey=True)
         axes = axes.flatten()
         for i in range(len(variables)):
-            sns.violinplot(data=self.data.df, x=x, y=variables[i], hue=hue, split=True,
-                palette=sns.color_palette('colorblind'), ax=axes[i], showfliers = False, dodge=False)
+            violins = {}
+            for (j, k), mask in masks.items():
+                values = matrix[mask, i]
+                values = values[~np.isnan(values)]
+                if len(values):
+                    violins[j, k] = (values, *self.kde(values))
+            max_density = max(density.max() for _, _, density in violins.values())
+            for (j, k), (values, support, density) in violins.items():
+                offset = (-1 if k == 0 else 1) * density / max_density * self.width / 2
+                axes[i].fill_betweenx(support, j, j + offset, facecolor=colors[k], edgecolor=".25",
+                                      linewidth=self.linewidth, label=hue_levels[k] if j == 0 else None)
+            for j in range(len(x_levels)):
+                values = np.concatenate([violins[j, k][0] for k in range(2) if (j, k) in violins])
+                self.draw_box(axes[i], values, j)
             axes[i].set_title(camel_case_split(variables[i]), fontsize=fontsize)
-            axes[i].set_xlabel(None)
-            axes[i].set_ylabel(None)
-            xticklabels = [txt.get_text() for txt in axes[i].get_xticklabels()]
-            axes[i].set_xticklabels([x_labels[lab] for lab in xticklabels])
-            axes[i].legend().set_visible(False)
+            axes[i].set_xticks(range(len(x_levels)))
+            axes[i].set_xticklabels([x_labels[str(lab)] for lab in x_levels])
+            axes[i].set_xlim(-.5, len(x_levels) - .5)
 
         axes[0].set_ylabel("Z Scores")
         axes[4].set_ylabel("Z Scores")
@@ -161,6 +307,15 @@ class ViolinPlot(Figure):
         
         fig.subplots_adjust(wspace=0)
 
+    def draw_box(self, ax, values: np.ndarray, center: float) -> None:
+        """ Draw the quartiles, median and whiskers of values as lines at the center of a violin """
+        q25, q50, q75 = np.percentile(values, [25, 50, 75])
+        whisker_lim = 1.5 * (q75 - q25)
+        h1, h2 = values[values >= q25 - whisker_lim].min(), values[values <= q75 + whisker_lim].max()
+        ax.plot([center, center], [h1, h2], linewidth=self.linewidth, color=".25")
+        ax.plot([center, center], [q25, q75], linewidth=self.linewidth * 3, color=".25")
+        ax.scatter(center, q50, zorder=3, color="white", edgecolor=".25", s=np.square(self.linewidth * 2))
+
 
 class TopFeatures(Figure):
 
@@ -177,7 +332,9 @@ class TopFeatures(Figure):
 
     def plot(self):
         labels = [self.format_label(x) for x in self.data.imaging_feature_names]
-        viz = FeatureImportances(self.model.best_estimator_.named_steps.clf, topn=20, labels=labels)
+        fig = self.new_figure()
+        viz = FeatureImportances(self.model.best_estimator_.named_steps.clf, topn=20, labels=labels,
+                                 ax=fig.subplots(), fig=fig)
         viz.fit(self.data.train.imaging, self.data.train.target)
         viz.finalize()
     
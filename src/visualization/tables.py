@@ -1,14 +1,13 @@
 from abc import ABC, abstractmethod
-import re
 import os
 
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+from joblib import Parallel, delayed
 
 from ..data.build import DataBuilder
-from ..data.dataset import Dataset
-from ..filepaths import PATH_RESULTS_DIR
+from ..filepaths import PATH_DATA_DIR, PATH_RESULTS_DIR
 from ..utils import camel_case_split
 
 
@@ -28,120 +27,223 @@ class Table(ABC):
         self.results.to_csv(os.path.join(PATH_RESULTS_DIR, "tables", filename))
 
 
-class KWTestsPvC(Table):
+class GroupTests(Table):
+    """ Mean and SD of each variable by group, with Kruskal-Wallis tests and optional resampled p-values and CIs """
+
+    indicator_vars = ['sex', 'dx']
+    group_var = None
+    groups = None
+
+    # Resampled statistics are computed in this many batches, spread over n_jobs processes
+    n_batches = 16
+
+    def __init__(self, data, group_var: str | None = None, groups: dict | None = None,
+                 variables: list | None = None, n_permutations: int = 0, n_bootstrap: int = 0, 
+                 confidence: float = 0.95, n_jobs: int = -1, random_state: int | None = None) -> None:
+        super().__init__(data)
+        self.group_var = group_var or self.group_var
+        if self.group_var is None:
+            raise ValueError("A group variable must be given")
+        self.groups = groups or self.groups
+        self.variables = variables or self.get_variables()
+        self.n_permutations = n_permutations
+        self.n_bootstrap = n_bootstrap
+        self.confidence = confidence
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def get_variables(self) -> list:
+        return self.data.cognitive_feature_names
+
+    def get_matrix(self, df: pd.DataFrame) -> np.ndarray:
+        """ Return the variables as a matrix, with levels of the indicator_vars as 0/1 indicators """
+        columns = []
+        for variable in self.variables:
+            if variable in df.columns:
+                columns.append(df[variable].to_numpy(dtype=float))
+                continue
+            for var in self.indicator_vars:
+                if var in df.columns and (df[var] == variable).any():
+                    columns.append((df[var] == variable).to_numpy(dtype=float))
+                    break
+            else:
+                raise ValueError(f"Variable is not a column or a level of {self.indicator_vars}: {variable}")
+        return np.column_stack(columns)
+
+    @staticmethod
+    def rank(X: np.ndarray) -> tuple:
+        """ 
+        Return the average ranks of each column of X as the rows of a matrix, and the correction
+        for ties of each column, which is NaN for columns with missing or identical values
+        """
+        n, n_vars = X.shape
+        X = np.ascontiguousarray(X.T)
+        order = np.argsort(X, axis=1)
+        X_sorted = np.take_along_axis(X, order, axis=1)
+
+        # Runs of tied values in each sorted column share the average of the ranks they span
+        positions = np.broadcast_to(np.arange(n), X_sorted.shape)
+        starts = np.ones_like(X_sorted, dtype=bool)
+        starts[:, 1:] = X_sorted[:, 1:] != X_sorted[:, :-1]
+        runs = np.cumsum(starts, axis=1) - 1 + np.arange(n_vars)[:, None] * n
+        ties = np.bincount(runs.ravel(), minlength=n * n_vars)
+        first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+        ranks = np.empty_like(X)
+        np.put_along_axis(ranks, order, first + (ties[runs] + 1) / 2, axis=1)
+
+        correction = 1 - (ties ** 3 - ties).reshape(n_vars, n).sum(axis=1) / (n ** 3 - n)
+        correction[(correction <= 0) | np.isnan(X).any(axis=1)] = np.nan
+        return ranks, correction
+
+    @staticmethod
+    def h_statistic(rank_sums: np.ndarray, counts: np.ndarray, correction: np.ndarray) -> np.ndarray:
+        """ Return H from the rank sums of each group, in the last axis, of any number of variables """
+        n = counts.sum()
+        return (12 / (n * (n + 1)) * (rank_sums ** 2 / counts).sum(axis=-1) - 3 * (n + 1)) / correction
+
+    @classmethod
+    def kruskal(cls, X: np.ndarray, codes: np.ndarray, n_groups: int) -> tuple:
+        """ Return the Kruskal-Wallis H statistic and p-value of each column of X """
+        ranks, correction = cls.rank(X)
+        H = cls.h_statistic(ranks @ np.eye(n_groups)[codes], np.bincount(codes, minlength=n_groups), correction)
+        return H, stats.chi2.sf(H, n_groups - 1)
+
+    @classmethod
+    def permutation_batch(cls, ranks: np.ndarray, codes: np.ndarray, n_groups: int, correction: np.ndarray,
+                          n_permutations: int, seed) -> np.ndarray:
+        """ Return the H statistics of each variable for a batch of random shuffles of the group labels """
+        # Ranks do not depend on the labels, so only the rank sums of each shuffle are recomputed
+        rng = np.random.default_rng(seed)
+        shuffles = rng.permuted(np.tile(codes, (n_permutations, 1)), axis=1)
+        rank_sums = np.stack([(shuffles == g).astype(float) @ ranks.T for g in range(n_groups)], axis=-1)
+        return cls.h_statistic(rank_sums, np.bincount(codes, minlength=n_groups), correction)
+
+    @staticmethod
+    def bootstrap_batch(X_groups: list, n_bootstrap: int, seed) -> np.ndarray:
+        """ 
+        Return the means of each variable in each group for a batch of resamples drawn with replacement
+        within each group, as one matrix product per group with the counts of each row in each resample
+        """
+        rng = np.random.default_rng(seed)
+        means = []
+        for X in X_groups:
+            weights = rng.multinomial(len(X), np.full(len(X), 1 / len(X)), size=n_bootstrap) / len(X)
+            means.append(weights @ X)
+        return np.stack(means, axis=1)
+
+    def resample(self, X: np.ndarray, codes: np.ndarray, n_groups: int, H: np.ndarray) -> tuple:
+        """ Return permutation p-values of H, and bootstrap means of each group and variable """
+        ranks, correction = self.rank(X)
+        seeds = np.random.SeedSequence(self.random_state).spawn(2 * self.n_batches)
+        with Parallel(n_jobs=self.n_jobs) as parallel:
+            p_perm, boot_means = None, None
+            if self.n_permutations:
+                H_perm = np.concatenate(parallel(
+                    delayed(self.permutation_batch)(ranks, codes, n_groups, correction, len(batch), seed)
+                    for batch, seed in zip(np.array_split(np.arange(self.n_permutations), self.n_batches), seeds)
+                    if len(batch)
+                ))
+                p_perm = (1 + (H_perm >= H - 1e-12).sum(axis=0)) / (1 + self.n_permutations)
+                p_perm[np.isnan(H)] = np.nan
+            if self.n_bootstrap:
+                X_groups = [X[codes == g] for g in range(n_groups)]
+                boot_means = np.concatenate(parallel(
+                    delayed(self.bootstrap_batch)(X_groups, len(batch), seed)
+                    for batch, seed in zip(np.array_split(np.arange(self.n_bootstrap), self.n_batches), 
+                                           seeds[self.n_batches:])
+                    if len(batch)
+                ))
+        return p_perm, boot_means
 
     def get(self):
-        
         df = self.data.df
-        df = pd.concat([df, pd.get_dummies(df['sex'])], axis=1)
-
-        patients_df = df[df['subjectType'] == 'patient']
-        controls_df = df[df['subjectType'] == 'control']
+        groups = self.groups or {str(value): value for value in sorted(df[self.group_var].dropna().unique())}
+        df = df[df[self.group_var].isin(list(groups.values()))]
+        codes = df[self.group_var].map({value: i for i, value in enumerate(groups.values())}).to_numpy()
+        X = self.get_matrix(df)
+
+        grouped = pd.DataFrame(X, columns=self.variables).groupby(codes)
+        means, sds = grouped.mean(), grouped.std()
+        H, p = self.kruskal(X, codes, len(groups))
         results = {}
-        
-        for variable in ['age', 'Female'] + self.data.cognitive_feature_names:
-            result = stats.kruskal(patients_df[variable], controls_df[variable])
-            results[variable] = {
-                "Controls M": round(controls_df[variable].mean(), 2),
-                "Controls SD": round(controls_df[variable].std(), 2),
-                "Patients M": round(patients_df[variable].mean(), 2),
-                "Patients SD": round(patients_df[variable].std(), 2),
-                "H": round(result.statistic, 2),
-                "p": round(result.pvalue, 3)
-            }
-        self.results = pd.DataFrame(results).T
+        for i, label in enumerate(groups):
+            results[f"{label} M"] = means.loc[i].round(2)
+            results[f"{label} SD"] = sds.loc[i].round(2)
+        results["H"] = pd.Series(H, index=self.variables).round(2)
+        results["p"] = pd.Series(p, index=self.variables).round(3)
+
+        if self.n_permutations or self.n_bootstrap:
+            p_perm, boot_means = self.resample(X, codes, len(groups), H)
+            if p_perm is not None:
+                results["p (perm)"] = pd.Series(p_perm, index=self.variables).round(3)
+            if boot_means is not None:
+                labels = list(groups)
+                alpha = (1 - self.confidence) / 2
+                for i, label in enumerate(labels[1:], start=1):
+                    diffs = boot_means[:, i] - boot_means[:, 0]
+                    low, high = np.quantile(diffs, [alpha, 1 - alpha], axis=0)
+                    name = f"{label} - {labels[0]}"
+                    results[f"{name} Diff"] = (means.loc[i] - means.loc[0]).round(2)
+                    results[f"{name} CI Low"] = pd.Series(low, index=self.variables).round(2)
+                    results[f"{name} CI High"] = pd.Series(high, index=self.variables).round(2)
+
+        self.results = pd.DataFrame(results)
         self.results.index = self.results.index.map(camel_case_split)
-        self.results['p'] = np.where(self.results['p'] < .001, "<.001", self.results['p'])
+        for col in ['p', 'p (perm)']:
+            if col in self.results:
+                self.results[col] = np.where(self.results[col] < .001, "<.001", self.results[col])
 
 
-class KWTestsClusters(Table):
+class KWTestsPvC(GroupTests):
 
-    def get(self):
-        df = self.data.df
-        df = pd.concat([df, pd.get_dummies(df['sex'])], axis=1)
-        df = pd.concat([df, pd.get_dummies(df['dx'])], axis=1)
-        
-        df0 = df[df['class'] == 0]
-        df1 = df[df['class'] == 1]
+    group_var = 'subjectType'
+    groups = {"Controls": "control", "Patients": "patient"}
 
-        results = {}
-        
-        results = {}
-        for variable in ['age', "Female", "Only Mood Disorder", \
-                        "SSD + Mood Disorder", 'Only SSD'] + self.data.cognitive_feature_names:
-            result = stats.kruskal(df0[variable], df1[variable])
-            results[variable] = {
-                "Class 0 M": round(df0[variable].mean(), 2),
-                "Class 0 SD": round(df0[variable].std(), 2),
-                "Class 1 M": round(df1[variable].mean(), 2),
-                "Class 1 SD": round(df1[variable].std(), 2),
-                "H": round(result.statistic, 2),
-                "p": round(result.pvalue, 3)
-            }
-        self.results = pd.DataFrame(results).T
-        self.results.index = self.results.index.map(camel_case_split)
-        self.results['p'] = np.where(self.results['p'] < .001, "<.001", self.results['p'])
+    def get_variables(self) -> list:
+        return ['age', 'Female'] + self.data.cognitive_feature_names
 
-class KWTestsDX(Table):
 
-    def get(self):
-        
-        df = self.data.df
-        
-        mood = df[df['dx'] == 'Only Mood Disorder']
-        both = df[df['dx'] == 'SSD + Mood Disorder']
-        ssd = df[df['dx'] == 'Only SSD']
+class KWTestsClusters(GroupTests):
 
-        results = {}
-        for variable in self.data.cognitive_feature_names:
-            result = stats.kruskal(mood[variable], both[variable], ssd[variable])
-            results[variable] = {
-                "Only Mood Disorder M": round(mood[variable].mean(), 2),
-                "Only Mood Disorder SD": round(mood[variable].std(), 2),
-                "SSD + Mood Disorder M": round(both[variable].mean(), 2),
-                "SSD + Mood Disorder SD": round(both[variable].std(), 2),
-                "Only SSD M": round(ssd[variable].mean(), 2),
-                "Only SSD SD": round(ssd[variable].std(), 2),
-                "H": round(result.statistic, 2),
-                "p": round(result.pvalue, 3)
-            }
-        self.results = pd.DataFrame(results).T
-        self.results.index = self.results.index.map(camel_case_split)
-        self.results['p'] = np.where(self.results['p'] < .001, "<.001", self.results['p'])
+    group_var = 'class'
+    groups = {"Class 0": 0, "Class 1": 1}
+
+    def get_variables(self) -> list:
+        return ['age', "Female", "Only Mood Disorder", "SSD + Mood Disorder", 'Only SSD'] + \
+            self.data.cognitive_feature_names
+
+
+class KWTestsDX(GroupTests):
+
+    group_var = 'dx'
+    groups = {dx: dx for dx in ["Only Mood Disorder", "SSD + Mood Disorder", "Only SSD"]}
 
 
 class Diagnoses(Table):
-    
-    def __init__(self):
+    """
+    Number and percent of patients with each SSD or mood disorder code, and their mean age and
+    percent female, from the long-format diagnosis index saved with the dataset. Codes are labelled
+    with their meanings, and percents are out of the number of patients in the dataset.
+    """
+
+    code_pattern = r"F[23]\d"
+
+    def __init__(self, output_dir: str = PATH_DATA_DIR, version: int | None = None):
+        self.output_dir = output_dir
+        self.version = version
         self.results = None
     
     def get(self):
-        processed = Dataset.load_patients()
-        data = DataBuilder(drop_dx=False, drop_na=False)
-        df = pd.DataFrame(data.df[data.df['id'].isin(processed.df['id'])], copy=True)
-        dx_cols = [col for col in data.df.columns if col.startswith("diagnoses")]
-        df[dx_cols] = df[dx_cols].applymap(lambda x: x if type(x) == str and "F" in x else np.NaN)
-        diagnoses = {}
-        for idx, row in df[dx_cols].iterrows():
-            subj_id = df.loc[idx, 'id']
-            for j in row:
-                if isinstance(j, float):
-                    continue
-                if re.match(f"F2\d", j) or re.match(r"F3\d", j):
-                    if j not in diagnoses:
-                        diagnoses[j] = [subj_id]
-                    else:
-                        diagnoses[j].append(subj_id)
-        
-        n = {k:len(v) for k, v in diagnoses.items()}
-        perc = {k : round(v / 680 * 100, 2) for k,v in n.items()}
-        ages = {}
-        female = {}
-        
-        for dx in diagnoses:
-            dx_age = [int(df.loc[df['id'] == subj_id, 'age']) for subj_id in diagnoses[dx]]
-            dx_female = int(sum(np.where([df.loc[df['id'] == subj_id, 'sex'] == "Female" for subj_id in diagnoses[dx]], 1, 0)))
-            ages[dx] = round(np.mean(dx_age), 2)
-            female[dx] = round(dx_female / len(diagnoses[dx]) * 100, 2)
-        
-        self.results = pd.DataFrame({"N": n, "Percent": perc, 'Age': ages, "Female": female}).sort_index()
\ No newline at end of file
+        df = DataBuilder.load(self.output_dir, self.version)
+        patients = df.loc[df['subjectType'] == 'patient', [DataBuilder.idvar, 'age', 'sex']]
+        diagnoses = DataBuilder.load_diagnoses(self.output_dir, self.version)
+        diagnoses = diagnoses[diagnoses['code'].astype(str).str.match(self.code_pattern)]
+        diagnoses = diagnoses.merge(patients, on=DataBuilder.idvar)
+        diagnoses['female'] = (diagnoses['sex'] == "Female") * 100
+        diagnoses['code'] = diagnoses['code'].astype(str).map(DataBuilder.variables['diagnoses']['Coding']).fillna(
+            diagnoses['code'].astype(str))
+
+        self.results = diagnoses.groupby('code').agg(N=('age', 'size'), Age=('age', 'mean'), Female=('female', 'mean'))
+        self.results.insert(1, 'Percent', self.results['N'] / len(patients) * 100)
+        self.results = self.results.round(2).sort_index()
+        self.results.index.name = None